@@ -25,43 +25,52 @@
 #Counter = common.Counter
 #Metric  = common.Metric
 
-def init_options(options_new, options_saved):
+def _get_saved(saved):
+    # Index the saved descriptors by name
+    return dict((descr.name, descr) for descr in saved)
+
+
+def init_options(selection, options_new, options_saved):
     assert isinstance(options_saved, list), 'Wrong contents in options'
 
+    saved = _get_saved(options_saved)
+
     # Initialize on values with the ones stored in the file (if any)
     for option_new in options_new:
-        option_saved = [ option for option in options_saved if option.name == option_new.name ]
-        if len(option_saved) == 1:
-            option_new.set_active(option_saved[0].active)
+        option_saved = saved.get(option_new.name)
+        if option_saved != None:
+            selection.set_active(option_new, option_saved.active)
 
 
-def init_counters(counters_new, counters_saved):
+def init_counters(selection, counters_new, counters_saved):
+    saved = _get_saved(counters_saved)
+
     # Initialize counter values with the ones stored in the file (if any)
     for counters in counters_new.values():
         # Only merge those counters found in both dictionaries
         for counter_new in counters:
-            counter_saved = [ counter for counter in counters_saved if counter.name == counter_new.name ]
-            if len(counter_saved) == 1:
-                counter_new.set_active(counter_saved[0].active)
+            counter_saved = saved.get(counter_new.name)
+            if counter_saved != None:
+                selection.set_active(counter_new, counter_saved.active)
+
 
+def init_metrics(selection, metrics_new, metrics_saved):
+    saved = _get_saved(metrics_saved)
 
-def init_metrics(metrics_new, metrics_saved):
     # Initialize metric values with the ones stored in the file (if any)
     for metrics in metrics_new.values():
         # Only merge those metrics found in both dictionaries
         for metric_new in metrics:
-            metric_saved = [ metric for metric in metrics_saved if metric.name == metric_new.name ]
-            if len(metric_saved) == 1:
-                metric_new.set_active(metric_saved[0].active)
+            metric_saved = saved.get(metric_new.name)
+            if metric_saved != None:
+                selection.set_active(metric_new, metric_saved.active)
 
 
 
-def print_counters(tag, counters):
+def print_counters(tag, selection):
     print tag
-    for ctrs in counters.values():
-        for counter in ctrs:
-            if counter.active == True:
-                print counter
+    for counter in selection.get_enabled_counters():
+        print counter
 
 
 # vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -0,0 +1,154 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Alignment of the rows of the logs written by the replays of a program. Each replay should execute the same
+# kernel launches and memory transfers, but programs that adapt to their input (or are not deterministic) may not.
+# Rows are identified by their method name, their launch configuration (when the gridsize/threadblocksize options
+# are enabled) and the number of previous rows with the same method and configuration, and are matched across
+# logs with a hash join. Rows that are not found in some log get missing cells for the columns of that log, and
+# rows that are not in the first log keep the position they have in their own log.
+
+import itertools
+
+import numpy
+
+# Columns that identify the launch configuration of a kernel
+CONFIG_COLUMNS = [ 'gridsizeX', 'gridsizeY', 'gridsizeZ',
+                   'threadblocksizeX', 'threadblocksizeY', 'threadblocksizeZ' ]
+
+
+class AlignmentStats(object):
+    # Result of the alignment of a set of logs: number of merged rows and number of rows of each log
+    def __init__(self, nrows, log_rows, aligned):
+        self.nrows    = nrows
+        self.log_rows = log_rows
+        # True if the rows of all the logs matched one by one
+        self.aligned  = aligned
+
+    def get_missing(self):
+        return [ self.nrows - rows for rows in self.log_rows ]
+
+    def __repr__(self):
+        if self.aligned:
+            return 'Alignment: %d rows' % self.nrows
+
+        missing = [ '%d/%d' % (n, self.nrows) for n in self.get_missing() ]
+        return 'Alignment: %d rows, missing rows per log: %s' % (self.nrows, ', '.join(missing))
+
+
+def _get_key_columns(logs):
+    # Columns that identify the rows of all the logs (None if rows can only be matched by position)
+    for log in logs:
+        if 'method' not in log.columns:
+            return None
+
+    return [ 'method' ] + [ column for column in CONFIG_COLUMNS
+                                   if all(column in log.columns for log in logs) ]
+
+
+def _iter_keys(log, key_columns):
+    if key_columns == None:
+        for n in range(len(log)):
+            yield (n,)
+        return
+
+    seqs = {}
+
+    for fields in log.iter_fields(key_columns):
+        key = tuple(fields)
+
+        seq = seqs.get(key, 0)
+        seqs[key] = seq + 1
+
+        yield key + (seq,)
+
+
+# Aligns the rows of the given ProfileLog objects. Returns the lines of each log that go into each merged row (an
+# array per log, where -1 means that the row is missing in that log), or None if the rows of all the logs match one
+# by one, and the AlignmentStats
+def align_logs(logs):
+    key_columns = _get_key_columns(logs)
+
+    log_rows = [ len(log) for log in logs ]
+
+    if len(set(log_rows)) <= 1:
+        # Common case: check the keys in lockstep, without keeping them
+        aligned = True
+
+        for keys in itertools.izip(*[ _iter_keys(log, key_columns) for log in logs ]):
+            if keys.count(keys[0]) != len(keys):
+                aligned = False
+                break
+
+        if aligned:
+            nrows = log_rows[0] if len(logs) > 0 else 0
+            return None, AlignmentStats(nrows, log_rows, True)
+
+    # Hash join: merged rows follow the order of the first log. Rows not found in previous logs go right after the
+    # previous row of their own log
+    index = {}
+    log_indexes = []
+
+    # Rows inserted after each row (-1 for the ones inserted before the first row)
+    inserted = {}
+
+    for log in logs:
+        rows = []
+        previous = -1
+
+        for key in _iter_keys(log, key_columns):
+            row = index.get(key)
+            if row == None:
+                row = len(index)
+                index[key] = row
+
+                if len(log_indexes) > 0:
+                    inserted.setdefault(previous, []).append(row)
+
+            rows.append(row)
+            previous = row
+
+        log_indexes.append(rows)
+
+    nrows = len(index)
+
+    # Order of the merged rows
+    order = []
+    pending = list(reversed(log_indexes[0])) + list(reversed(inserted.get(-1, [])))
+
+    while len(pending) > 0:
+        row = pending.pop()
+        order.append(row)
+        pending.extend(reversed(inserted.get(row, [])))
+
+    positions = numpy.empty(nrows, dtype = numpy.int64)
+    positions[order] = numpy.arange(nrows, dtype = numpy.int64)
+
+    lines = []
+
+    for rows in log_indexes:
+        log_lines = numpy.empty(nrows, dtype = numpy.int64)
+        log_lines.fill(-1)
+        log_lines[positions[rows]] = numpy.arange(len(rows), dtype = numpy.int64)
+
+        lines.append(log_lines)
+
+    return lines, AlignmentStats(nrows, log_rows, False)
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
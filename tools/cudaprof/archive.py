@@ -0,0 +1,277 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Archives of profiling sessions, used to compute metrics after the fact. An archive contains the merged table of
+# raw counter values of each GPU (as a binary columnar file) and a snapshot of the catalog: the counters collected,
+# their domains, and the metrics that can be computed from them. Metrics are recomputed either with formulas given
+# by the user, which do not need a GPU, or with CUPTI (on a device of the same kind as the profiled one).
+
+import json
+import os
+import re
+import tempfile
+
+import numpy
+
+import cudaprof.columnar as columnar
+import cudaprof.cuda     as cuda
+import cudaprof.libs     as libs
+from cudaprof.common import Counter, Domain, Metric, Option
+from cudaprof.table import Column, MISSING
+
+CATALOG_FILE    = 'catalog.json'
+ARCHIVE_VERSION = 1
+
+# Functions available in the formulas
+FORMULA_FUNCTIONS = { 'minimum': numpy.minimum,
+                      'maximum': numpy.maximum,
+                      'where'  : numpy.where,
+                      'sqrt'   : numpy.sqrt,
+                      'log'    : numpy.log,
+                      'abs'    : numpy.abs }
+
+_FORMULA_LINE = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.+?)\s*$')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def get_table_file_name(archive_dir, gpu):
+    return os.path.join(archive_dir, 'counters_%d.bin' % gpu)
+
+
+def write_catalog(archive_dir, options, counters, metrics, gpus):
+    # Snapshot of the catalog needed to compute the given metrics from the given counters. Written once the tables
+    # of all the GPUs are complete
+    domains = dict((counter.domain.id, counter.domain) for counter in counters)
+
+    snapshot = { 'version' : ARCHIVE_VERSION,
+                 'device'  : list(cuda.DEVICES[0]) if len(cuda.DEVICES) > 0 else None,
+                 'gpus'    : gpus,
+                 'options' : [ [ option.name, option.value ] for option in options ],
+                 'domains' : [ { 'name'      : domain.name,
+                                 'id'        : domain.id,
+                                 'i_profiled': domain.i_profiled,
+                                 'i_total'   : domain.i_total } for domain in domains.values() ],
+                 'counters': [ { 'name'    : counter.name,
+                                 'id'      : counter.id,
+                                 'category': counter.category,
+                                 'domain'  : counter.domain.id } for counter in counters ],
+                 'metrics' : [ { 'name'          : metric.name,
+                                 'id'            : metric.id,
+                                 'category'      : metric.category,
+                                 'value_kind'    : metric.value_kind,
+                                 'eval_instance' : metric.eval_instance,
+                                 'eval_aggregate': metric.eval_aggregate,
+                                 'counters'      : [ counter.id for counter in metric.counters ] }
+                               for metric in metrics ] }
+
+    # Write to a temporary file and rename it, so an archive is never used before it is complete
+    _f, f_name = tempfile.mkstemp(dir = archive_dir)
+    f = os.fdopen(_f, 'w')
+    json.dump(snapshot, f, indent = 1)
+    f.close()
+
+    os.rename(f_name, os.path.join(archive_dir, CATALOG_FILE))
+
+
+class Archive(object):
+    # Contents of an archive: the options, Counters and Metrics of the snapshot, and the tables of each GPU
+    def __init__(self, archive_dir):
+        self.path = archive_dir
+
+        try:
+            f = open(os.path.join(archive_dir, CATALOG_FILE))
+            snapshot = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            raise ArchiveError('Error reading archive %s' % archive_dir)
+
+        if snapshot.get('version') != ARCHIVE_VERSION:
+            raise ArchiveError('Unsupported archive version in %s' % archive_dir)
+
+        self.device = tuple(snapshot['device']) if snapshot['device'] != None else None
+        self.gpus   = snapshot['gpus']
+
+        self.options = [ Option(str(name), '', value) for name, value in snapshot['options'] ]
+
+        domains = dict((domain['id'], Domain(str(domain['name']), domain['id'],
+                                             domain['i_profiled'], domain['i_total']))
+                       for domain in snapshot['domains'])
+
+        self.counters = []
+        for counter in snapshot['counters']:
+            self.counters.append(Counter(str(counter['name']), '', counter['category'], counter['id'],
+                                         domains[counter['domain']]))
+
+        counters_by_id = dict((counter.id, counter) for counter in self.counters)
+
+        self.metrics = []
+        for metric in snapshot['metrics']:
+            self.metrics.append(Metric(str(metric['name']), '', metric['category'], metric['id'],
+                                       metric['value_kind'], metric['eval_instance'], metric['eval_aggregate'],
+                                       [ counters_by_id[counter] for counter in metric['counters'] ]))
+
+        self.aggregate_mode = any(option.name == 'countermodeaggregate' for option in self.options)
+
+    def get_metric(self, name):
+        for metric in self.metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def get_table(self, gpu):
+        f = columnar.ColumnarFile(get_table_file_name(self.path, gpu))
+        try:
+            return f.get_table()
+        finally:
+            f.close()
+
+
+def load_formulas(f_name):
+    # Reads a file with one "metric = expression" line per metric (lines starting with # are comments)
+    formulas = {}
+
+    f = open(f_name)
+    for n, line in enumerate(f):
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+
+        match = _FORMULA_LINE.match(line)
+        if match == None:
+            raise ArchiveError('%s:%d: expected "metric = expression"' % (f_name, n + 1))
+
+        formulas[match.group(1)] = match.group(2)
+    f.close()
+
+    return formulas
+
+
+class FormulaBackend(object):
+    # Computes metrics with numeric expressions of the counter values. Expressions can use the name of any counter
+    # (divided by the number of instances of its domain in aggregate mode, as for CUPTI), duration (the kernel time
+    # in ns) and the FORMULA_FUNCTIONS
+    def __init__(self, formulas):
+        self.formulas = {}
+
+        for name, expression in formulas.items():
+            try:
+                self.formulas[name] = compile(expression, '<%s>' % name, 'eval')
+            except SyntaxError:
+                raise ArchiveError('Invalid formula for %s: %s' % (name, expression))
+
+    def __contains__(self, name):
+        return name in self.formulas
+
+    def compute(self, name, data, counters, aggregate_mode):
+        env = dict(FORMULA_FUNCTIONS)
+        env['__builtins__'] = {}
+        env['duration'] = data['gputime'].toarray(numpy.float64) * 1e3
+
+        for counter in counters:
+            if counter.name not in data:
+                continue
+
+            # Counters are never negative: -1 is the padding of the rows without counters (e.g. memory transfers)
+            values = data[counter.name].toarray(numpy.float64)
+            values[values < 0] = numpy.nan
+            values[data[counter.name].get_missing()] = numpy.nan
+
+            if aggregate_mode:
+                values = values / counter.domain.i_total
+
+            env[counter.name] = values
+
+        error = numpy.seterr(divide = 'ignore', invalid = 'ignore')
+        try:
+            values = eval(self.formulas[name], env)
+        except Exception as e:
+            raise ArchiveError('Error in the formula of %s: %s' % (name, e))
+        finally:
+            numpy.seterr(**error)
+
+        values = numpy.asarray(values, dtype = numpy.float64)
+        if values.shape != (data.nlines,):
+            values = numpy.resize(values, data.nlines)
+
+        missing = numpy.flatnonzero(numpy.isnan(values)).tolist()
+        if len(missing) > 0:
+            return Column.from_array(values, dict.fromkeys(missing, MISSING))
+
+        return values
+
+
+# Computes the given metrics for each GPU of the archive in archive_dir and writes them (next to the profiler
+# option columns) to the files given by out_pattern. Metrics with a formula are computed with it, and the rest with
+# CUPTI, if cupti is True and it is available
+def recompute(archive_dir, metric_names, out_pattern, formulas = None, cupti = True):
+    # Imported here, since the runner writes archives
+    import cudaprof.runner as runner
+
+    archive = Archive(archive_dir)
+    backend = FormulaBackend(formulas or {})
+
+    cupti_metrics = []
+
+    for name in metric_names:
+        if name in backend:
+            continue
+
+        metric = archive.get_metric(name)
+        if metric == None:
+            raise ArchiveError('Metric %s is not in the archive and has no formula' % name)
+        cupti_metrics.append(metric)
+
+    if len(cupti_metrics) > 0:
+        if not cupti or not libs.is_available():
+            raise ArchiveError('Metrics without formula need CUPTI: %s' %
+                               ', '.join([ metric.name for metric in cupti_metrics ]))
+
+        cuda.init()
+
+        if archive.device != None and tuple(cuda.DEVICES[0]) != archive.device:
+            raise ArchiveError('The archive was created on a different device (%s)' % archive.device[0])
+
+    counters = dict((counter.name, counter) for counter in archive.counters)
+
+    for gpu in range(archive.gpus):
+        data = archive.get_table(gpu)
+
+        metric_values = {}
+
+        if len(cupti_metrics) > 0:
+            metric_values = cuda.compute_metrics(gpu, cupti_metrics, data.columns, data, data.nlines,
+                                                 counters, archive.aggregate_mode)
+            runner._mask_missing_metrics(data, cupti_metrics, metric_values)
+
+        for name in metric_names:
+            if name in backend:
+                metric_values[name] = backend.compute(name, data, archive.counters, archive.aggregate_mode)
+
+        columns = [ column for column in data.columns if column not in counters ] + list(metric_names)
+
+        f = open(out_pattern % gpu, 'w')
+        f.write(','.join(columns) + '\n')
+        runner._write_lines(f, columns, data, metric_values)
+        f.close()
+
+    return archive
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -0,0 +1,251 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the processing of the profiler logs (merge, metric computation and output), which does not need a
+# GPU: the logs are synthetic and CUDA/CUPTI are replaced by stubs. Each configuration runs in its own process, so
+# the peak RSS reported only depends on that configuration.
+
+import multiprocessing
+import Queue
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import cudaprof.cuda   as cuda
+import cudaprof.libs   as libs
+import cudaprof.runner as runner
+from cudaprof.common import Counter, Domain, Metric
+
+MAX_COUNTERS = 100
+
+# Lines generated at once when writing the synthetic logs
+LOG_CHUNK_LINES = 16384
+
+# One out of every MEMCPY_EVERY rows is a memory transfer, which does not have counter values
+MEMCPY_EVERY = 8
+
+METHODS = [ 'memcpyHtoD', 'kernel_a', 'kernel_b', 'kernel_c' ]
+
+PHASES = [ 'merge', 'metrics', 'write' ]
+
+
+class StubCUDA(object):
+    # Functions of libcuda used by cuda.init(), for a single fake device
+    def cuInit(self, flags):
+        return 0
+
+    def cuDriverGetVersion(self, version):
+        version._obj.value = 5000
+        return 0
+
+    def cuDeviceGetCount(self, count):
+        count._obj.value = 1
+        return 0
+
+    def cuDeviceGetName(self, name, length, device):
+        name.value = 'Stub device'
+        return 0
+
+    def cuDeviceComputeCapability(self, major, minor, device):
+        major._obj.value = 3
+        minor._obj.value = 5
+        return 0
+
+
+class StubCUPTI(object):
+    # Functions of libcupti used to compute metrics. Metric values are the first counter value per ns, so the stub
+    # adds as little as possible to the time of the metrics phase
+    def cuptiGetVersion(self, version):
+        version._obj.value = 4
+        return 0
+
+    def cuptiMetricGetValue(self, device, metric, nbytes_event_id, event_ids, nbytes_values, values, duration,
+                            value):
+        value._obj.metricValueDouble = float(values[0]) / max(duration, 1)
+        return 0
+
+
+def load_stubs():
+    libs.load_stub_libraries(StubCUDA(), StubCUPTI())
+
+
+def get_counters(ncounters):
+    domain = Domain('stub', 0, 1, 1)
+
+    return [ Counter('counter%d' % i, '', 0, i, domain) for i in range(ncounters) ]
+
+
+def get_metrics(counters, nmetrics):
+    # Each metric needs two counters, taken round-robin
+    return [ Metric('metric%d' % i, '', 0, i, libs.CUPTI.metric_value_kind.DOUBLE, False, True,
+                    [ counters[i % len(counters)], counters[(i + 1) % len(counters)] ])
+             for i in range(nmetrics) ]
+
+
+# Writes a synthetic log of the command line profiler with nrows rows and the given counters. The logs written with
+# the same seed have the same rows, so they can be merged as the logs of the replays of a program
+def write_log(f_name, nrows, counters, seed = 0):
+    random = numpy.random.RandomState(seed)
+
+    f = open(f_name, 'w')
+    f.write('# CUDA_PROFILE_LOG_VERSION 2.0\n')
+    f.write('# CUDA_DEVICE 0 Stub device\n')
+    f.write(','.join([ 'gpustarttimestamp', 'method', 'gputime', 'cputime', 'occupancy' ] +
+                     [ counter.name for counter in counters ]) + '\n')
+
+    kernel_format = '%x,%s,%.3f,%.3f,%.3f' + ',%d' * len(counters)
+
+    start = 0x1294e16c1d2d0000
+
+    for first in range(0, nrows, LOG_CHUNK_LINES):
+        n = min(LOG_CHUNK_LINES, nrows - first)
+
+        gputimes  = random.uniform(1, 1000, n)
+        cputimes  = gputimes + random.uniform(1, 10, n)
+        occupancy = random.uniform(0, 1, n)
+        starts    = start + numpy.cumsum((gputimes * 1000).astype(numpy.int64) + 1000)
+        start     = int(starts[-1])
+
+        values = random.randint(0, 1 << 30, (n, len(counters)))
+
+        lines = []
+        for row in range(n):
+            method = METHODS[(first + row) % len(METHODS)]
+
+            if (first + row) % MEMCPY_EVERY == 0:
+                lines.append('%x,%s,%.3f,%.3f' % (starts[row], METHODS[0], gputimes[row], cputimes[row]))
+            else:
+                if method == METHODS[0]:
+                    method = METHODS[1]
+                lines.append(kernel_format % ((starts[row], method, gputimes[row], cputimes[row], occupancy[row]) +
+                                              tuple(values[row].tolist())))
+
+        f.write('\n'.join(lines) + '\n')
+
+    f.close()
+
+
+class Result(object):
+    # Time (in s) of each phase and peak RSS (in KB) of the benchmark of one configuration
+    def __init__(self, nrows, ncounters, nmetrics, times, rss):
+        self.nrows     = nrows
+        self.ncounters = ncounters
+        self.nmetrics  = nmetrics
+        self.times     = times
+        self.rss       = rss
+
+    def get_rate(self, phase = None):
+        # Rows processed per second by the given phase (all of them by default)
+        if phase == None:
+            elapsed = sum(self.times.values())
+        else:
+            elapsed = self.times[phase]
+
+        return self.nrows / elapsed if elapsed > 0 else float('inf')
+
+
+def _run(out_dir, nrows, ncounters, nmetrics, ngroups):
+    load_stubs()
+    cuda.init()
+
+    counters = get_counters(ncounters)
+    metrics  = get_metrics(counters, nmetrics)
+
+    # Counters of each replay
+    groups = [ counters[i::ngroups] for i in range(ngroups) ]
+
+    files = []
+    for i, group in enumerate(groups):
+        f_name = os.path.join(out_dir, 'cuda_profile_%d_0.log' % i)
+        write_log(f_name, nrows, group)
+        files.append(f_name)
+
+    times = {}
+
+    start = time.time()
+    data, alignment = runner.merge_files(files)
+    times['merge'] = time.time() - start
+
+    start = time.time()
+    metric_values = cuda.compute_metrics(0, metrics, data.columns, data, data.nlines,
+                                         dict((counter.name, counter) for counter in counters), False)
+    times['metrics'] = time.time() - start
+
+    start = time.time()
+    f = open(os.path.join(out_dir, 'out_0.log'), 'w')
+    columns = data.columns + [ metric.name for metric in metrics ]
+    f.write(','.join(columns) + '\n')
+    runner._write_lines(f, columns, data, metric_values)
+    f.close()
+    times['write'] = time.time() - start
+
+    return Result(nrows, ncounters, nmetrics, times, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _run_child(queue, *args):
+    queue.put(_run(*args))
+
+
+# Runs the benchmark of one configuration: merge the logs of ngroups replays (with nrows rows and ncounters
+# counters in total), compute nmetrics metrics and write the output. Returns its Result
+def run(nrows, ncounters, nmetrics, ngroups = 1, out_dir = None):
+    assert ncounters <= MAX_COUNTERS, 'Too many counters'
+    assert 0 < ngroups <= ncounters, 'Invalid number of groups'
+
+    tempdir = tempfile.mkdtemp(prefix = 'cuda-profiler-bench.', dir = out_dir)
+
+    try:
+        queue = multiprocessing.Queue()
+
+        process = multiprocessing.Process(target = _run_child,
+                                          args = (queue, tempdir, nrows, ncounters, nmetrics, ngroups))
+        process.start()
+
+        result = None
+        while result == None:
+            try:
+                result = queue.get(timeout = 1)
+            except Queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError('Benchmark process failed with exit code %d' % process.exitcode)
+
+        process.join()
+    finally:
+        shutil.rmtree(tempdir)
+
+    return result
+
+
+def write_results(f, results):
+    f.write('rows,counters,metrics,' + ','.join([ '%s_s' % phase for phase in PHASES ]) +
+            ',' + ','.join([ '%s_rows_per_s' % phase for phase in PHASES ]) + ',rows_per_s,peak_rss_kb\n')
+
+    for result in results:
+        records = [ result.nrows, result.ncounters, result.nmetrics ]
+        records += [ '%.3f' % result.times[phase] for phase in PHASES ]
+        records += [ '%.0f' % result.get_rate(phase) for phase in PHASES ]
+        records += [ '%.0f' % result.get_rate(), result.rss ]
+
+        f.write(','.join([ str(record) for record in records ]) + '\n')
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -0,0 +1,80 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+import zlib
+
+# Persistent caches can be disabled (e.g. from the command line)
+ENABLED = True
+
+def get_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'cudaprof')
+
+
+def get_key(*values):
+    return hashlib.sha1(repr(values)).hexdigest()
+
+
+def _get_path(kind, key):
+    return os.path.join(get_cache_dir(), '%s-%s.pickle' % (kind, key))
+
+
+def load(kind, key):
+    if not ENABLED:
+        return None
+
+    try:
+        f = open(_get_path(kind, key), 'rb')
+    except IOError:
+        return None
+
+    try:
+        return pickle.loads(zlib.decompress(f.read()))
+    except Exception:
+        # Corrupted or incompatible entry
+        return None
+    finally:
+        f.close()
+
+
+def store(kind, key, obj):
+    if not ENABLED:
+        return
+
+    cache_dir = get_cache_dir()
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Write to a temporary file and rename it, so readers never see partial entries
+        _f, f_name = tempfile.mkstemp(dir = cache_dir)
+        f = os.fdopen(_f, 'wb')
+        f.write(zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)))
+        f.close()
+
+        os.rename(f_name, _get_path(kind, key))
+    except (IOError, OSError):
+        print 'Error writing cache entry to %s' % cache_dir
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
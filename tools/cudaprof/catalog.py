@@ -0,0 +1,183 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cudaprof
+
+
+class Catalog(object):
+    # Options, counters and metrics supported by a device, indexed for constant-time lookups.
+    #  - options: list of Option
+    #  - counters: dictionary of category name -> list of Counter
+    #  - metrics: dictionary of category name -> list of Metric
+    def __init__(self, options, counters, metrics):
+        self.options  = options
+        self.counters = counters
+        self.metrics  = metrics
+
+        self.options_by_name = dict((option.name, option) for option in options)
+
+        self.counters_by_name   = {}
+        self.counters_by_id     = {}
+        self.counters_by_domain = {}
+        self.domains            = {}
+
+        for counter in self.get_counters():
+            self.counters_by_name[counter.name] = counter
+            self.counters_by_id[counter.id]     = counter
+
+            domain = counter.domain
+            if domain.id not in self.domains:
+                self.domains[domain.id]            = domain
+                self.counters_by_domain[domain.id] = []
+
+            self.counters_by_domain[domain.id].append(counter)
+
+        self.metrics_by_name    = {}
+        self.metrics_by_id      = {}
+        # Metrics that depend on each counter (by counter id)
+        self.metrics_by_counter = {}
+
+        for metric in self.get_metrics():
+            self.metrics_by_name[metric.name] = metric
+            self.metrics_by_id[metric.id]     = metric
+
+            for counter in set(counter.id for counter in metric.counters):
+                self.metrics_by_counter.setdefault(counter, []).append(metric)
+
+        # Position of each element in the selection bitsets
+        self.bits = {}
+        for element in self.options + self.get_counters() + self.get_metrics():
+            self.bits[element] = len(self.bits)
+
+    # Iterators over all the elements in the catalog
+    def get_counters(self):
+        return [ counter for _counters in self.counters.values()
+                         for counter in _counters ]
+
+    def get_metrics(self):
+        return [ metric for _metrics in self.metrics.values()
+                        for metric in _metrics ]
+
+    # Lookups
+    def get_option(self, name):
+        return self.options_by_name.get(name)
+
+    def get_counter(self, name):
+        return self.counters_by_name.get(name)
+
+    def get_counter_by_id(self, id):
+        return self.counters_by_id.get(id)
+
+    def get_metric(self, name):
+        return self.metrics_by_name.get(name)
+
+    def get_metric_by_id(self, id):
+        return self.metrics_by_id.get(id)
+
+    def get_computable_metrics(self, counters):
+        # Metrics that can be computed from the values of the given counters alone
+        ids = set(counter.id for counter in counters)
+
+        candidates = set(metric for counter in ids
+                                for metric in self.metrics_by_counter.get(counter, []))
+
+        return [ metric for metric in self.get_metrics()
+                        if metric in candidates and
+                           not metric.is_internal() and
+                           all(counter.id in ids for counter in metric.counters) ]
+
+    def get_category_counters(self, category):
+        return self.counters.get(category, [])
+
+    def get_category_metrics(self, category):
+        return self.metrics.get(category, [])
+
+    def get_domain_counters(self, domain):
+        return self.counters_by_domain.get(domain.id, [])
+
+
+class Selection(object):
+    # Active/inactive state of the elements of a Catalog, stored in a compact bitset. Each session (or window)
+    # has its own selection, while the catalog is shared.
+    def __init__(self, catalog, bits = None):
+        self.catalog = catalog
+
+        if bits == None:
+            bits = bytearray((len(catalog.bits) + 7) // 8)
+        self.bits = bits
+
+    def copy(self):
+        return Selection(self.catalog, bytearray(self.bits))
+
+    def is_active(self, element):
+        bit = self.catalog.bits[element]
+        return (self.bits[bit >> 3] >> (bit & 7)) & 1 == 1
+
+    def set_active(self, element, active):
+        bit = self.catalog.bits[element]
+        if active:
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+        else:
+            self.bits[bit >> 3] &= ~(1 << (bit & 7)) & 0xff
+
+    def reset(self):
+        self.bits = bytearray(len(self.bits))
+
+    def get_enabled_options(self):
+        return [ option for option in self.catalog.options if self.is_active(option) ]
+
+    def get_enabled_counters(self):
+        return [ counter for counter in self.catalog.get_counters() if self.is_active(counter) ]
+
+    def get_enabled_metrics(self):
+        return [ metric for metric in self.catalog.get_metrics() if self.is_active(metric) ]
+
+    def get_required_counters(self, counters = None, metrics = None):
+        # Closure of the counters needed to collect the given counters and compute the given metrics (the enabled
+        # ones by default). Counters are returned in order of appearance and without duplicates.
+        if counters == None:
+            counters = self.get_enabled_counters()
+        if metrics == None:
+            metrics = self.get_enabled_metrics()
+
+        required = []
+        seen     = set()
+
+        for counter in counters + [ counter for metric in metrics for counter in metric.counters ]:
+            if counter.id not in seen:
+                seen.add(counter.id)
+                required.append(self.catalog.counters_by_id[counter.id])
+
+        return required
+
+    def get_free_metrics(self, counters = None):
+        # Metrics not enabled that can be computed from the given counters (the required ones by default), so they
+        # do not need any additional replay
+        if counters == None:
+            counters = self.get_required_counters()
+
+        return [ metric for metric in self.catalog.get_computable_metrics(counters) if not self.is_active(metric) ]
+
+    def set_conf(self, options_saved, counters_saved, metrics_saved):
+        # Merge the configuration read from a file
+        cudaprof.init_options(self, self.catalog.options, options_saved)
+        cudaprof.init_counters(self, self.catalog.counters, counters_saved)
+        cudaprof.init_metrics(self, self.catalog.metrics, metrics_saved)
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
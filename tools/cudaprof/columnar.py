@@ -0,0 +1,366 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Binary columnar output format. The file is laid out as:
+#
+#   MAGIC | VERSION (uint32) | padding | column data ... | footer (JSON) | footer offset (uint64) | MAGIC
+#
+# Column data is stored contiguously and aligned to 8 bytes, so it can be memory-mapped and used in place. The
+# footer describes each column: its name, NumPy dtype, offset in the file and encoding:
+#  - plain: fixed-width little-endian numbers
+#  - dictionary: int32 codes into the list of categories stored in the footer (e.g. kernel names)
+#  - delta: int64 differences between consecutive values (timestamps, which are hexadecimal in the logs)
+#
+# Missing cells are NaN in float columns. Integer columns keep their values exact and store missing cells as the
+# sentinel given by the 'missing' entry of their descriptor (only present if the column has missing cells)
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy
+
+from cudaprof.common import enum
+from cudaprof.log import get_timestamp, TIMESTAMP_COLUMNS
+from cudaprof.table import Column, COLUMN_KINDS, MISSING, ProfileTable
+
+MAGIC     = 'CUDAPROF'
+VERSION   = 1
+ALIGNMENT = 8
+
+ENCODINGS = enum(PLAIN      = 'plain',
+                 DICTIONARY = 'dictionary',
+                 DELTA      = 'delta')
+
+_CODE_DTYPE  = numpy.dtype('<i4')
+_DELTA_DTYPE = numpy.dtype('<i8')
+
+# Value of the missing cells of integer columns
+MISSING_INT = numpy.iinfo(numpy.int64).min
+
+
+def get_file_name(out_file):
+    # Name of the binary file written next to (or instead of) the CSV file out_file
+    return os.path.splitext(out_file)[0] + '.bin'
+
+
+def _get_values(name, column):
+    # Values of a column of a ProfileTable: a NumPy array for numeric columns, a list otherwise
+    if name in TIMESTAMP_COLUMNS:
+        return numpy.array([ get_timestamp(value) for value in column.tolist() ], dtype = _DELTA_DTYPE)
+
+    exceptions = column.exceptions.values()
+
+    if not column.is_numeric() or any(isinstance(value, str) and value != MISSING for value in exceptions):
+        return column.tolist()
+
+    missing = column.get_missing()
+
+    if column.values.dtype.kind == 'f' or any(isinstance(value, float) for value in exceptions):
+        # Missing cells are stored as NaN
+        values = column.toarray(numpy.float64)
+        values[missing] = numpy.nan
+        return values
+
+    if len(missing) > 0:
+        values = column.toarray(numpy.int64)
+        values[missing] = MISSING_INT
+        return values
+
+    return column.toarray(column.values.dtype)
+
+
+def _astype(values, dtype):
+    # Converts the values of a column, keeping its missing cells (MISSING_INT becomes NaN in float columns)
+    converted = values.astype(dtype)
+
+    if values.dtype.kind == 'i' and dtype.kind == 'f':
+        converted[values == MISSING_INT] = numpy.nan
+
+    return converted
+
+
+class _ColumnSpill(object):
+    # Temporary file with the data of one column, written chunk by chunk
+    def __init__(self, name, tempdir):
+        self.name = name
+        self.f    = tempfile.TemporaryFile(dir = tempdir)
+
+        # Compared with "is", since numpy.dtype(None) is float64 and so float64 == None
+        self.dtype      = None
+        self.encoding   = ENCODINGS.DELTA if name in TIMESTAMP_COLUMNS else None
+        self.categories = None
+        self.codes      = None
+        self.missing    = False
+        self.last       = 0
+        self.nlines     = 0
+
+    def _read(self):
+        self.f.seek(0)
+        values = numpy.frombuffer(self.f.read(), dtype = self.dtype)
+        self.f.seek(0)
+        self.f.truncate()
+
+        return values
+
+    def _write(self, values):
+        self.f.write(values.tostring())
+        self.nlines += len(values)
+
+    def _set_dictionary(self):
+        # Convert the numbers written so far into categories
+        values = self._read().tolist() if self.dtype is not None else []
+
+        self.nlines     = 0
+        self.dtype      = _CODE_DTYPE
+        self.encoding   = ENCODINGS.DICTIONARY
+        self.categories = []
+        self.codes      = {}
+
+        self._append_categories(values)
+
+    def _append_categories(self, values):
+        codes = numpy.empty(len(values), dtype = _CODE_DTYPE)
+
+        for i, value in enumerate(values):
+            value = '%s' % value
+
+            code = self.codes.get(value)
+            if code == None:
+                code = len(self.categories)
+                self.codes[value] = code
+                self.categories.append(value)
+
+            codes[i] = code
+
+        self._write(codes)
+
+    def append(self, values):
+        if self.encoding == ENCODINGS.DELTA:
+            self.dtype = _DELTA_DTYPE
+
+            if len(values) > 0:
+                deltas = numpy.concatenate(([ values[0] - self.last ], numpy.diff(values)))
+                self.last = values[-1]
+                self._write(deltas.astype(_DELTA_DTYPE))
+            return
+
+        if isinstance(values, list):
+            if self.encoding != ENCODINGS.DICTIONARY:
+                self._set_dictionary()
+            self._append_categories(values)
+
+        elif self.encoding == ENCODINGS.DICTIONARY:
+            self._append_categories(values.tolist())
+
+        else:
+            dtype = values.dtype.newbyteorder('<')
+
+            if self.dtype is None:
+                self.dtype    = dtype
+                self.encoding = ENCODINGS.PLAIN
+            elif dtype != self.dtype:
+                # Promote the data written so far (e.g. integer columns that get float values)
+                dtype = numpy.promote_types(self.dtype, dtype).newbyteorder('<')
+                if dtype != self.dtype:
+                    previous = self._read()
+
+                    self.nlines = 0
+                    self.dtype  = dtype
+                    self._write(_astype(previous, dtype))
+
+            if values.dtype.kind == 'i' and (values == MISSING_INT).any():
+                self.missing = True
+
+            self._write(_astype(values, self.dtype))
+
+    def get_descriptor(self, offset):
+        if self.dtype is None:
+            # Empty column
+            self.dtype    = numpy.dtype('<i8')
+            self.encoding = ENCODINGS.PLAIN
+
+        descriptor = { 'name'    : self.name,
+                       'dtype'   : self.dtype.str,
+                       'encoding': self.encoding,
+                       'offset'  : offset }
+
+        if self.encoding == ENCODINGS.DICTIONARY:
+            descriptor['categories'] = self.categories
+        elif self.missing and self.dtype.kind == 'i':
+            descriptor['missing'] = MISSING_INT
+
+        return descriptor
+
+
+class ColumnarWriter(object):
+    # Writes the contents of ProfileTable chunks (plus the metric values computed for them) to a binary columnar
+    # file. Columns are spilled to temporary files until the writer is closed
+    def __init__(self, f_name):
+        self.f_name  = f_name
+        self.columns = None
+        self.spills  = None
+        self.nlines  = 0
+
+    def write(self, columns, data, metric_values):
+        if self.columns == None:
+            tempdir = os.path.dirname(os.path.abspath(self.f_name))
+
+            self.columns = list(columns)
+            self.spills  = [ _ColumnSpill(column, tempdir) for column in columns ]
+
+        for column, spill in zip(self.columns, self.spills):
+            if column in data:
+                spill.append(_get_values(column, data[column]))
+            elif isinstance(metric_values[column], Column):
+                spill.append(_get_values(column, metric_values[column]))
+            else:
+                spill.append(metric_values[column])
+
+        self.nlines += data.nlines
+
+    def close(self):
+        f = open(self.f_name, 'wb')
+        f.write(MAGIC + struct.pack('<I', VERSION))
+
+        descriptors = []
+
+        for spill in self.spills or []:
+            assert spill.nlines == self.nlines, 'Wrong number of lines in column %s' % spill.name
+
+            # Align the column data
+            f.write('\0' * (-f.tell() % ALIGNMENT))
+
+            descriptors.append(spill.get_descriptor(f.tell()))
+
+            spill.f.seek(0)
+            shutil.copyfileobj(spill.f, f)
+            spill.f.close()
+
+        footer_offset = f.tell()
+        f.write(json.dumps({ 'nlines': self.nlines, 'columns': descriptors }))
+        f.write(struct.pack('<Q', footer_offset) + MAGIC)
+
+        f.close()
+
+
+class ColumnarFile(object):
+    # Reader of binary columnar files. The file is memory-mapped and columns are returned as NumPy arrays that
+    # point to the mapped data (without copies), except for delta-encoded columns, which have to be decoded
+    def __init__(self, f_name):
+        f = open(f_name, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        tail = len(MAGIC) + 8
+
+        if len(self.map) < len(MAGIC) + 4 + tail or \
+           self.map[:len(MAGIC)] != MAGIC or self.map[-len(MAGIC):] != MAGIC:
+            raise ValueError('Not a columnar profile file: %s' % f_name)
+
+        version, = struct.unpack('<I', self.map[len(MAGIC):len(MAGIC) + 4])
+        if version != VERSION:
+            raise ValueError('Unsupported columnar profile file version: %d' % version)
+
+        footer_offset, = struct.unpack('<Q', self.map[-tail:-len(MAGIC)])
+        footer = json.loads(self.map[footer_offset:-tail])
+
+        self.nlines      = footer['nlines']
+        self.columns     = [ str(descriptor['name']) for descriptor in footer['columns'] ]
+        self.descriptors = dict(zip(self.columns, footer['columns']))
+
+    def __contains__(self, column):
+        return column in self.descriptors
+
+    def __getitem__(self, column):
+        values = self.get_raw(column)
+
+        if self.descriptors[column]['encoding'] == ENCODINGS.DELTA:
+            return numpy.cumsum(values)
+
+        return values
+
+    def __len__(self):
+        return self.nlines
+
+    def get_raw(self, column):
+        # Stored values of the column: numbers, dictionary codes or deltas
+        descriptor = self.descriptors[column]
+        dtype = numpy.dtype(str(descriptor['dtype']))
+
+        if self.nlines == 0:
+            return numpy.zeros(0, dtype = dtype)
+
+        return numpy.frombuffer(self.map, dtype = dtype, count = self.nlines, offset = descriptor['offset'])
+
+    def get_missing(self, column):
+        # Lines of the missing cells of a numeric column
+        values = self[column]
+
+        if values.dtype.kind == 'f':
+            return numpy.flatnonzero(numpy.isnan(values))
+        elif 'missing' in self.descriptors[column]:
+            return numpy.flatnonzero(values == self.descriptors[column]['missing'])
+
+        return numpy.zeros(0, dtype = numpy.int64)
+
+    def get_categories(self, column):
+        return [ category.encode('utf-8') for category in self.descriptors[column].get('categories', []) ]
+
+    def tolist(self, column):
+        values = self[column].tolist()
+
+        if self.descriptors[column]['encoding'] == ENCODINGS.DICTIONARY:
+            categories = self.get_categories(column)
+            values = [ categories[code] for code in values ]
+
+        return values
+
+    def get_table(self):
+        # Contents of the file as a ProfileTable. Missing cells (NaN or the sentinel of integer columns) are MISSING
+        # again, and timestamps are hexadecimal strings, as in the profiler logs
+        data = []
+
+        for column in self.columns:
+            values = numpy.array(self[column])
+
+            if column in TIMESTAMP_COLUMNS:
+                timestamps = ProfileTable.from_rows([ column ], ([ '%x' % value if value >= 0 else MISSING ]
+                                                                 for value in values.tolist()))
+                data.append(timestamps[column])
+            elif self.descriptors[column]['encoding'] == ENCODINGS.DICTIONARY:
+                data.append(Column(COLUMN_KINDS.CATEGORY, values.astype(numpy.int32),
+                                   [ intern(category) for category in self.get_categories(column) ]))
+            else:
+                if values.dtype.kind != 'f':
+                    values = values.astype(numpy.int64)
+
+                data.append(Column.from_array(values, dict.fromkeys(self.get_missing(column).tolist(), MISSING)))
+
+        return ProfileTable(self.columns, data, self.nlines)
+
+    def close(self):
+        self.map.close()
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -16,6 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import threading
 from datetime import datetime
 
 def now():
@@ -25,13 +27,95 @@ def now():
 def enum(**enums):
     return type('Enum', (), enums)
 
-class Option:
+class LRUCache(object):
+    # Bounded, thread-safe cache that discards the least recently used entries first
+    def __init__(self, size):
+        self.size    = size
+        self.entries = collections.OrderedDict()
+        self.lock    = threading.Lock()
+
+        self.hits   = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default = None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # Move the entry to the most recently used position
+            self.entries[key] = value
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+            elif len(self.entries) >= self.size:
+                self.entries.popitem(last = False)
+
+            self.entries[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits   = 0
+            self.misses = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+
+        return float(self.hits) / lookups
+
+    def __repr__(self):
+        return 'LRUCache: %d/%d entries, %d hits, %d misses (%.1f%% hit rate)' % (len(self.entries), self.size,
+                                                                                  self.hits, self.misses,
+                                                                                  self.hit_rate() * 100)
+
+
+class Descriptor(object):
+    # Base class of the (immutable) elements of a catalog. Descriptors can be shared by any number of sessions
+    # without copying them: whether they are active or not is stored in a separate Selection.
+    __slots__ = ()
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s objects are immutable' % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s objects are immutable' % self.__class__.__name__)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class Option(Descriptor):
+    __slots__ = ('name', 'description', 'value')
+
     def __init__(self, name, description, value = None):
-        self.name        = name
-        self.description = description
-        self.value       = value
+        self._set('name',        intern(name))
+        self._set('description', description)
+        self._set('value',       value)
 
-        self.active = False
+    def __reduce__(self):
+        return (Option, (self.name, self.description, self.value))
 
     def __repr__(self):
         if self.value != None:
@@ -39,19 +123,27 @@ class Option:
         else:
             return '%s' % (self.name)
 
-    def set_active(self, active):
-        self.active = active
 
+class Domain(Descriptor):
+    __slots__ = ('name', 'id', 'i_profiled', 'i_total')
 
-class Domain(dict):
     def __init__(self, name, id, i_profiled, i_total):
-        self.name       = name
-        self.id         = id
-        self.i_profiled = i_profiled
-        self.i_total    = i_total
+        self._set('name',       intern(name))
+        self._set('id',         id)
+        self._set('i_profiled', i_profiled)
+        self._set('i_total',    i_total)
+
+    def __reduce__(self):
+        return (Domain, (self.name, self.id, self.i_profiled, self.i_total))
 
+    def __repr__(self):
+        ret = 'Domain: %s' % (self.name)
+        return ret
+
+
+class Counter(Descriptor):
+    __slots__ = ('name', 'description', 'category', 'id', 'domain')
 
-class Counter(object):
     CATEGORIES = {
                    0: 'Instruction',
                    1: 'Memory',
@@ -60,26 +152,27 @@ class Counter(object):
                  }
 
     def __init__(self, name, description, category, id, domain):
-        self.name        = name
-        self.description = description
-        self.category    = category
-        self.id          = id
-        self.domain      = domain
+        self._set('name',        intern(name))
+        self._set('description', description)
+        self._set('category',    category)
+        self._set('id',          id)
+        self._set('domain',      domain)
 
-        self.active = False
+    def __reduce__(self):
+        return (Counter, (self.name, self.description, self.category, self.id, self.domain))
 
     def __repr__(self):
         ret = 'Counter: %s' % (self.name)
         return ret
 
-    def set_active(self, active):
-        self.active = active
-
     def is_internal(self):
         return self.name[0:2] == '__'
 
 
-class Metric(object):
+class Metric(Descriptor):
+    __slots__ = ('name', 'description', 'category', 'id', 'value_kind', 'eval_instance', 'eval_aggregate',
+                 'counters')
+
     CATEGORIES = {
                     0: 'Memory',
                     1: 'Instruction',
@@ -90,25 +183,22 @@ class Metric(object):
 
     def __init__(self, name, description, category, id, value_kind,
                  evaluation_instance, evaluation_aggregate, counters):
-        self.name        = name
-        self.description = description
-        self.category    = category
-        self.id          = id
-        self.value_kind  = value_kind
-        self.eval_instance  = evaluation_instance
-        self.eval_aggregate = evaluation_aggregate
-        self.counters    = counters
-
-        self.active = False
+        self._set('name',           intern(name))
+        self._set('description',    description)
+        self._set('category',       category)
+        self._set('id',             id)
+        self._set('value_kind',     value_kind)
+        self._set('eval_instance',  evaluation_instance)
+        self._set('eval_aggregate', evaluation_aggregate)
+        self._set('counters',       tuple(counters))
+
+    def __reduce__(self):
+        return (Metric, (self.name, self.description, self.category, self.id, self.value_kind,
+                         self.eval_instance, self.eval_aggregate, self.counters))
 
     def __repr__(self):
         ret = 'Metric: %s' % (self.name)
         return ret
 
-    def set_active(self, active):
-        self.active = active
-
     def is_internal(self):
         return self.name[0:2] == '__'
-
-
@@ -0,0 +1,124 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cost of profiling a program with a given selection of options, counters and metrics, estimated before running
+# it: number of replays, groups needed by each metric, size of the output and (from a single timed run of the
+# program) wall time.
+
+import glob
+import shutil
+import tempfile
+
+import cudaprof.runner as runner
+from cudaprof.log import ProfileLog
+
+# Columns always written by the profiler
+DEFAULT_COLUMNS = [ 'method', 'gputime', 'cputime', 'occupancy' ]
+
+# Columns written for the options that do not produce a column with their own name
+OPTION_COLUMNS = { 'gridsize'            : [ 'gridsizeX', 'gridsizeY' ],
+                   'gridsize3d'          : [ 'gridsizeX', 'gridsizeY', 'gridsizeZ' ],
+                   'threadblocksize'     : [ 'threadblocksizeX', 'threadblocksizeY', 'threadblocksizeZ' ],
+                   'countermodeaggregate': [],
+                   'conckerneltrace'     : [],
+                   'enableonstart'       : [] }
+
+# Typical length of the values of each column in the CSV output (without the separator)
+COLUMN_BYTES = { 'method'           : 32,
+                 'gputime'          : 8,
+                 'cputime'          : 8,
+                 'occupancy'        : 5,
+                 'gpustarttimestamp': 16,
+                 'gpuendtimestamp'  : 16,
+                 'timestamp'        : 12,
+                 'memtransfersize'  : 8 }
+DEFAULT_COLUMN_BYTES = 4
+
+# Typical length of counter and metric values (metrics are written with the full precision of a float)
+COUNTER_BYTES = 10
+METRIC_BYTES  = 14
+
+
+def get_metric_groups(groups, metrics):
+    # Indexes of the groups that contain the counters needed by each metric
+    return dict((metric.name, sorted(set(i for i, group in enumerate(groups)
+                                           for counter in metric.counters if counter in group)))
+                for metric in metrics)
+
+
+def get_option_columns(options):
+    return DEFAULT_COLUMNS + [ column for option in options
+                                      for column in OPTION_COLUMNS.get(option.name, [ option.name ]) ]
+
+
+def get_row_bytes(options, counters, metrics, option_bytes = None):
+    # Estimated size in bytes of each row of the output. option_bytes is the measured size of the columns written
+    # by the profiler options (see run_baseline), if available
+    if option_bytes == None:
+        option_bytes = sum(COLUMN_BYTES.get(column, DEFAULT_COLUMN_BYTES) + 1
+                           for column in get_option_columns(options))
+
+    return option_bytes + len(counters) * (COUNTER_BYTES + 1) + len(metrics) * (METRIC_BYTES + 1)
+
+
+class Baseline(object):
+    # Timed run of the program with the profiler enabled but no counters
+    def __init__(self, elapsed, returncode, rows, option_bytes):
+        self.elapsed      = elapsed
+        self.returncode   = returncode
+        # Number of rows of the log of each GPU
+        self.rows         = rows
+        # Mean size in bytes of the rows of the logs (None if they are empty)
+        self.option_bytes = option_bytes
+
+
+def run_baseline(cmd, args, options, **kwargs):
+    tempdir = tempfile.mkdtemp(prefix = 'cuda-profiler-tools.')
+
+    try:
+        replays = runner.launch_groups_parallel(cmd, args, options, [ [] ], [ None ], None,
+                                                out_dir = tempdir,
+                                                tee = kwargs.get('tee', False), timeout = kwargs.get('timeout', None))
+        replay = replays[0]
+
+        if replay.timed_out:
+            raise runner.ReplayFailed(replays)
+
+        rows   = []
+        nbytes = 0
+
+        for gpu in range(len(glob.glob(tempdir + '/cuda_profile_%d_*.log' % replay.pid))):
+            log = ProfileLog(tempdir + '/cuda_profile_%d_%d.log' % (replay.pid, gpu), sidecar = False)
+
+            rows.append(len(log))
+            if len(log) > 0:
+                # Data lines, including their line breaks
+                nbytes += len(log.map) - int(log.offsets[0])
+
+            log.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+    option_bytes = None
+    if sum(rows) > 0:
+        option_bytes = float(nbytes) / sum(rows)
+
+    return Baseline(replay.elapsed, replay.returncode, rows, option_bytes)
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
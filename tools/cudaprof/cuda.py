@@ -16,17 +16,47 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import copy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
-from cudaprof.common import Counter, Domain, Metric, Option
+import numpy
+
+import cudaprof.cache as cache
+from cudaprof.catalog import Catalog
+from cudaprof.common import Counter, Domain, LRUCache, Metric, Option
 from cudaprof.libs import C, CUDA, CUPTI
 
 CUDA_FAKE_CONTEXT = None
 
 GPUS = 0
 
+# Partitions of counters into groups already computed in this session
+EVENT_GROUP_PLANS = {}
+
+# (name, compute capability major, minor) of each GPU
+DEVICES = []
+
+DRIVER_VERSION = 0
+CUPTI_VERSION  = 0
+
+# Version of the format of the cached catalogs
+CATALOG_VERSION = 2
+
 MAX_STRING_LEN = 1024
 
+# Number of lines evaluated at once when computing metrics
+METRIC_CHUNK_LINES = 16384
+
+# Number of threads used to compute metrics (ctypes releases the GIL in CUPTI calls)
+METRIC_THREADS = multiprocessing.cpu_count()
+METRIC_POOL = None
+
+# Cache of metric values, keyed by (device, metric id, counter values, duration bucket)
+METRIC_CACHE_SIZE = 1 << 16
+METRIC_CACHE = LRUCache(METRIC_CACHE_SIZE)
+# Width (in ns) of the duration buckets. A value of 1 only reuses metric values for identical durations
+METRIC_CACHE_BUCKET = 1
+
 PROFILER_OPTIONS = {
     'gpustarttimestamp'     : Option('gpustarttimestamp',
                                      'Time stamp when a kernel or memory transfer starts.'),
@@ -72,25 +102,30 @@ PROFILER_OPTIONS = {
 }
 
 
-def _get_elem(f, container):
-    for elem in container:
-        if f(elem) == True:
-            return elem
-
-    return None
-
-
 def init():
-    global CUDA_FAKE_CONTEXT
     global GPUS
+    global DEVICES
+    global DRIVER_VERSION
+    global CUPTI_VERSION
 
     # Initialize libs.CUDA
     CUDA.cuInit(0)
 
+    # Get driver and CUPTI versions
+    version = C.c_int(0)
+    CUDA.cuDriverGetVersion(C.byref(version))
+    DRIVER_VERSION = version.value
+
+    version = C.c_uint32(0)
+    CUPTI.cuptiGetVersion(C.byref(version))
+    CUPTI_VERSION = version.value
+
     # Get number of GPUs in the system
     GPUS = C.c_int(0)
     CUDA.cuDeviceGetCount(C.byref(GPUS))
 
+    DEVICES = []
+
     # Iterate for each GPU
     p = C.create_string_buffer(256)
     for gpu in range(GPUS.value):
@@ -99,16 +134,53 @@ def init():
         minor = C.c_int(0)
         CUDA.cuDeviceComputeCapability(C.byref(major), C.byref(minor), gpu)
 
+        DEVICES.append((p.value, major.value, minor.value))
+
+def get_context():
+    global CUDA_FAKE_CONTEXT
+
+    # The libs.CUDA context needed for event profiling is only created when it is first needed
+    if CUDA_FAKE_CONTEXT == None:
+        CUDA_FAKE_CONTEXT = C.c_void_p(0)
+        CUDA.cuCtxCreate_v2(C.byref(CUDA_FAKE_CONTEXT), 0, 0)
 
-    # Create a libs.CUDA context needed for event profiling
-    CUDA_FAKE_CONTEXT = C.c_void_p(0)
-    CUDA.cuCtxCreate_v2(C.byref(CUDA_FAKE_CONTEXT), 0, 0)
+    return CUDA_FAKE_CONTEXT
+
+def get_device_count():
+    if isinstance(GPUS, C.c_int):
+        return GPUS.value
+
+    return GPUS
 
 def is_valid_output_pattern(pattern):
     return pattern.count('%d') == 1
 
+def get_catalog_key():
+    # Counters and metrics are read from the first GPU
+    return cache.get_key(CATALOG_VERSION, DEVICES[0], DRIVER_VERSION, CUPTI_VERSION)
+
+
+def get_catalog():
+    key = get_catalog_key()
+
+    catalog = cache.load('catalog', key)
+    if catalog == None:
+        # Create counters
+        counters = get_counters()
+        # Create metrics
+        metrics = get_metrics(counters)
+
+        catalog = (counters, metrics)
+        cache.store('catalog', key, catalog)
+
+    counters, metrics = catalog
+
+    return Catalog(get_options(), counters, metrics)
+
+
 def get_options():
-    return copy.deepcopy(list(PROFILER_OPTIONS.values()))
+    # Options are immutable, so they can be shared
+    return list(PROFILER_OPTIONS.values())
 
 
 def get_counters():
@@ -210,29 +282,55 @@ def get_counters():
     return counters
 
 
-def get_event_groups(counters):
+def get_event_groups(counters, optimize = True):
+    # Partition of the counters into groups, each collected in a separate run of the program. Unless optimize is
+    # False, the groups returned by CUPTI are packed into as few groups as possible (see _pack_event_groups)
     if len(counters) == 0:
         return [[]]
 
-    counter_groups = []
-    # Collect event id's
-    event_ids = [ event.id for event in counters ]
+    # Look for the plan in the session and persistent caches
+    key = cache.get_key(get_catalog_key(), optimize, sorted(set([ counter.id for counter in counters ])))
+
+    plan = EVENT_GROUP_PLANS.get(key)
+    if plan == None:
+        plan = cache.load('groups', key)
+
+    if plan == None:
+        plan = _create_event_group_plan(counters)
+        if optimize:
+            plan = _pack_event_groups(counters, plan)
+        cache.store('groups', key, plan)
+
+    EVENT_GROUP_PLANS[key] = plan
+
+    # Collect the Counters for the events in each group
+    return [ [ counter for counter in counters if counter.id in group_ids ] for group_ids in plan ]
+
+
+def _create_event_group_sets(event_ids):
+    # Asks CUPTI to partition the given events. Returns the ids of the events of each group of each group set (the
+    # groups of a set can be collected at the same time), or None if CUPTI cannot collect the events
+    sets = []
 
     # Create group sets for the events
     groups_ptr = C.POINTER(CUPTI.group_sets)()
-    events = (CUPTI.event_t * len(counters))(*event_ids)
-    nbytes = C.c_size_t(C.sizeof(CUPTI.event_t) * len(counters))
+    events = (CUPTI.event_t * len(event_ids))(*event_ids)
+    nbytes = C.c_size_t(C.sizeof(CUPTI.event_t) * len(event_ids))
 
-    CUPTI.cuptiEventGroupSetsCreate(CUDA_FAKE_CONTEXT,
-                                    nbytes,
-                                    events,
-                                    C.byref(groups_ptr))
+    res = CUPTI.cuptiEventGroupSetsCreate(get_context(),
+                                          nbytes,
+                                          events,
+                                          C.byref(groups_ptr))
+    if res != 0 or not groups_ptr:
+        return None
 
     # Iterate for each group set
     groupsets_desc = groups_ptr[0]
     for groupset in range(groupsets_desc.numSets):
         groupset_desc = groupsets_desc.sets[groupset]
 
+        groups = []
+
         # Iterate for each group within the group set
         for group in range(groupset_desc.numEventGroups):
             group_desc = groupset_desc.eventGroups[group]
@@ -253,19 +351,82 @@ def get_event_groups(counters):
                                               C.byref(nbytes),
                                               C.cast(events, C.POINTER(CUPTI.event_t)))
 
-            # Collect the Counters for the events in the group
-            counter_group = [ counter for counter in counters if counter.id in events ]
-            counter_groups.append(counter_group)
+            # Store the ids of the events in the group
+            groups.append(frozenset(events))
+
+        sets.append(groups)
 
     # Free used resources
     CUPTI.cuptiEventGroupSetsDestroy(groups_ptr)
 
-    return counter_groups
+    return sets
+
+
+def _create_event_group_plan(counters):
+    sets = _create_event_group_sets([ event.id for event in counters ])
+    assert sets != None, 'CUPTI cannot collect the given counters'
+
+    # One group per run
+    return [ group for groups in sets
+                   for group in groups ]
+
+
+def _is_single_pass(event_ids):
+    # True if CUPTI can collect all the given events in a single run
+    sets = _create_event_group_sets(event_ids)
+
+    return sets != None and len(sets) == 1
+
+
+def _pack_event_groups(counters, plan):
+    # Packs the counters into the fewest groups that CUPTI can collect in a single run each (first-fit, with the
+    # counters of the domains with the most counters first). The group sets returned by CUPTI are often looser than
+    # the hardware limits of each domain. Returns the packed plan, or plan if packing does not save any run
+    by_domain = {}
+    for counter in counters:
+        by_domain.setdefault(counter.domain.id, []).append(counter)
+
+    ordered = [ counter for domain in sorted(by_domain, key = lambda domain: -len(by_domain[domain]))
+                        for counter in by_domain[domain] ]
+
+    # Counters of each domain in each group
+    groups  = []
+    domains = []
+
+    # Number of counters of each domain that a group cannot exceed (learnt from the failed probes)
+    limits = {}
+
+    for counter in ordered:
+        domain = counter.domain.id
+
+        for group, group_domains in zip(groups, domains):
+            n = group_domains.get(domain, 0)
+            if n >= limits.get(domain, len(counters)):
+                continue
+
+            if _is_single_pass([ c.id for c in group ] + [ counter.id ]):
+                group.append(counter)
+                group_domains[domain] = n + 1
+                break
+
+            if n > 0:
+                limits[domain] = min(limits.get(domain, len(counters)), n)
+        else:
+            if not _is_single_pass([ counter.id ]):
+                return plan
+
+            groups.append([ counter ])
+            domains.append({ domain: 1 })
+
+    if len(groups) >= len(plan):
+        return plan
+
+    return [ frozenset(counter.id for counter in group) for group in groups ]
 
 
 def get_metrics(counters):
-    counters_list = [ counter for _counters in counters.values()
-                              for counter in _counters ]
+    counters_map = dict((counter.id, counter) for _counters in counters.values()
+                                              for counter in _counters)
 
     metrics_ret = {}
 
@@ -334,8 +495,7 @@ def get_metrics(counters):
 
         metric_counters = []
         for event_id in events:
-            event = _get_elem(lambda e: e.id == event_id,
-                              counters_list)
+            event = counters_map.get(event_id)
 
             assert event != None, 'Event %d not in metric_counter list' % event_id
             metric_counters.append(event)
@@ -364,50 +524,146 @@ def num(s):
         return float(s)
 
 
-def get_val(data, line, metric, counter, aggregate_mode):
-    val = long(data[counter.name][line])
+def init_metric_cache(size, bucket = 1):
+    global METRIC_CACHE
+    global METRIC_CACHE_BUCKET
+
+    assert bucket > 0, 'Wrong duration bucket width'
+
+    METRIC_CACHE = LRUCache(size)
+    METRIC_CACHE_BUCKET = bucket
+
+
+def get_counter_values(data, counter, aggregate_mode):
+    values = data[counter.name].toarray(numpy.int64)
 
     if aggregate_mode:
-        val = val/counter.domain.i_total
+        values = values // counter.domain.i_total
     else:
         pass # Do nothing
 
-    return val
+    return values
+
+
+def get_metric_dtype(metric):
+    if metric.value_kind in (CUPTI.metric_value_kind.UINT64, CUPTI.metric_value_kind.THROUGHPUT):
+        return numpy.uint64
+
+    return numpy.float64
+
+
+def _get_pool():
+    global METRIC_POOL
+
+    if METRIC_POOL == None:
+        METRIC_POOL = ThreadPool(METRIC_THREADS)
+
+    return METRIC_POOL
+
+
+def _compute_metric_chunk(device, metric, counter_values, durations, metric_values, start, stop):
+    ncounters = len(metric.counters)
+
+    # Buffers used in all the calls for the metric
+    array_event_id = (CUPTI.event_t * ncounters)(*[ counter.id for counter in metric.counters ])
+    nbytes_event_id = C.c_size_t(C.sizeof(CUPTI.event_t) * ncounters)
+    values          = (C.c_uint64 * ncounters)()
+    nbytes_values   = C.c_size_t(C.sizeof(C.c_uint64) * ncounters)
+    value           = CUPTI.metric_value(0)
+
+    p_event_id = C.cast(array_event_id, C.POINTER(CUPTI.event_t))
+    p_values   = C.cast(values, C.POINTER(C.c_uint64))
+    p_value    = C.byref(value)
+
+    row_address = counter_values.ctypes.data
+    row_bytes   = nbytes_values.value
+
+    cache  = METRIC_CACHE
+    bucket = METRIC_CACHE_BUCKET
+
+    def evaluate(line, duration):
+        # Copy the counters of the line into the buffer
+        C.memmove(values, row_address + line * row_bytes, row_bytes)
+
+        CUPTI.cuptiMetricGetValue(device,
+                                  metric.id,
+                                  nbytes_event_id,
+                                  p_event_id,
+                                  nbytes_values,
+                                  p_values,
+                                  duration,
+                                  p_value)
+
+        return value.get_value(metric.value_kind)
+
+    durations = durations[start:stop]
+    if bucket > 1:
+        # Evaluate all the durations in the bucket with its central value
+        durations = (durations // bucket) * bucket + bucket // 2
+
+    if cache.size <= 0:
+        metric_values[start:stop] = [ evaluate(line, duration)
+                                      for line, duration in zip(range(start, stop), durations.tolist()) ]
+        return
+
+    # Look up (and evaluate) each distinct row of counter values and duration bucket of the chunk only once
+    keys = numpy.column_stack((counter_values[start:stop], durations // bucket))
+    unique_keys, first, inverse = numpy.unique(keys, axis = 0, return_index = True, return_inverse = True)
+
+    chunk_values = numpy.empty(len(unique_keys), dtype = metric_values.dtype)
+
+    for n, (row, line) in enumerate(zip(unique_keys.tolist(), first.tolist())):
+        key = (device, metric.id, tuple(row[:-1]), row[-1])
+
+        metric_value = cache.get(key)
+        if metric_value == None:
+            metric_value = evaluate(start + line, int(durations[line]))
+            cache.put(key, metric_value)
+
+        chunk_values[n] = metric_value
+
+    metric_values[start:stop] = chunk_values[inverse]
 
 
 def compute_metrics(device, metrics, columns, data, nlines, counters, aggregate_mode):
     metrics_values = {}
 
+    if nlines > METRIC_CHUNK_LINES:
+        pool = _get_pool()
+    else:
+        pool = None
+
+    # Convert from us to ns
+    durations = (data['gputime'].toarray(numpy.float64) * 1e3).astype(numpy.uint64)
+
+    # Counter values (normalized if needed) shared by all the metrics
+    counter_values = {}
+
     for metric in metrics:
-        # Get the indexes of the counters needed for each metric
-        metric_counter_ids = [ counter.id for counter in metric.counters ]
-        metrics_values[metric.name] = []
-
-        for line in range(nlines):
-            metric_counters = [ get_val(data, line, metric, counter, aggregate_mode)
-                                for counter in metric.counters ]
-
-            array_event_id_t = (CUPTI.event_t                     * len(metric_counters))
-            nbytes_event_id  = C.c_size_t(C.sizeof(CUPTI.event_t) * len(metric_counters))
-            values_t         = (C.c_uint64                        * len(metric_counters))
-            nbytes_values    = C.c_size_t(C.sizeof(C.c_uint64)    * len(metric_counters))
-            # Convert from us to ns
-            duration         = C.c_uint64(long(float(data['gputime'][line]) * 1e3))
-            value            = CUPTI.metric_value(0)
-
-            array_event_id = array_event_id_t(*metric_counter_ids)
-            values         = values_t(*metric_counters)
-
-            CUPTI.cuptiMetricGetValue(device,
-                                      metric.id,
-                                      nbytes_event_id,
-                                      C.cast(array_event_id, C.POINTER(CUPTI.event_t)),
-                                      nbytes_values,
-                                      C.cast(values, C.POINTER(C.c_uint64)),
-                                      duration,
-                                      C.byref(value))
-
-            metrics_values[metric.name].append(value.get_value(metric.value_kind))
+        for counter in metric.counters:
+            if counter.name not in counter_values:
+                counter_values[counter.name] = get_counter_values(data, counter, aggregate_mode)
+
+    for metric in metrics:
+        # Matrix with one row of counter values per line
+        metric_counter_values = numpy.empty((nlines, len(metric.counters)), dtype = numpy.uint64)
+        for i, counter in enumerate(metric.counters):
+            metric_counter_values[:, i] = counter_values[counter.name].view(numpy.uint64)
+
+        values = numpy.empty(nlines, dtype = get_metric_dtype(metric))
+
+        # Evaluate the metric in chunks of lines
+        chunks = [ (device, metric, metric_counter_values, durations, values,
+                    start, min(start + METRIC_CHUNK_LINES, nlines))
+                   for start in range(0, nlines, METRIC_CHUNK_LINES) ]
+
+        if pool != None:
+            pool.map(lambda args: _compute_metric_chunk(*args), chunks)
+        else:
+            for args in chunks:
+                _compute_metric_chunk(*args)
+
+        metrics_values[metric.name] = values
 
     return metrics_values
 
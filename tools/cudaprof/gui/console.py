@@ -16,34 +16,76 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+
 from cudaprof.common import now
+import cudaprof.cost   as cost
 import cudaprof.cuda   as cuda
 import cudaprof.runner as runner
 
-def start(options, counters, metrics, option_conf_file, option_cmd, option_cmd_args, option_out_pattern, option_deps_only):
-    # Collect enabled options
-    enabled_options = [ option for option in options if option.active == True ]
+def _get_size(nbytes):
+    for unit in [ 'B', 'KB', 'MB', 'GB' ]:
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.0
 
-    # Collect enabled events
-    enabled_counters = [ counter for _counters in counters.values()
-                                 for counter in _counters if counter.active == True ]
+    return '%.1f %s' % (nbytes, unit)
 
-    # Collect enabled metrics
-    enabled_metrics = [ metric for _metrics in metrics.values()
-                               for metric in _metrics if metric.active == True ]
 
-    # Enable counters needed by the metrics
-    for metric in enabled_metrics:
-        for metric_counter in metric.counters:
-            enabled_counter = [ counter for counter in enabled_counters if counter.name == metric_counter.name ]
+def print_plan(option_cmd, option_cmd_args, options, groups, metrics, enabled_counters, **kwargs):
+    # Dry run: cost of profiling the program with the given counter groups
+    print 'Replays: %d' % len(groups)
+
+    metric_groups = cost.get_metric_groups(groups, metrics)
+
+    for i, group in enumerate(groups):
+        group_metrics = [ metric.name for metric in metrics if i in metric_groups[metric.name] ]
+        if len([ counter for counter in group if counter in enabled_counters ]) > 0:
+            reason = 'counters'
+        else:
+            # Only needed by metrics
+            reason = 'metrics'
+
+        print 'Group %d (%s): %s' % (i, reason, ', '.join(group_metrics) if len(group_metrics) > 0 else '-')
+
+    for metric in metrics:
+        print 'Metric %s: groups %s' % (metric.name, ', '.join([ '%d' % i for i in metric_groups[metric.name] ]))
+
+    baseline = None
+
+    if option_cmd != None:
+        print "%s> Baseline run: '%s %s'" % (now(), option_cmd, option_cmd_args)
+        try:
+            baseline = cost.run_baseline(option_cmd, option_cmd_args, options, **kwargs)
+        except runner.ReplayError as e:
+            print "%s> %s" % (now(), e)
+            sys.exit(-1)
+
+        print "%s> Baseline run finished in %.2f s (exit code %d), rows per GPU: %s" % \
+              (now(), baseline.elapsed, baseline.returncode, ', '.join([ '%d' % rows for rows in baseline.rows ]))
+
+    row_bytes = cost.get_row_bytes(options, enabled_counters, metrics,
+                                   baseline.option_bytes if baseline != None else None)
+    print 'Output size: %d bytes per row' % row_bytes
+
+    if baseline != None:
+        gpus = max(cuda.get_device_count(), 1)
 
-            if len(enabled_counter) == 0:
-                # Not enabled by default
-                counter = [ counter for _counters in counters.values()
-                                    for counter in _counters if counter.name == metric_counter.name ]
-                assert len(counter) > 0, "Counter name not known"
+        print 'Projected output size: %s' % _get_size(row_bytes * sum(baseline.rows))
+        print 'Projected wall time: %.2f s (%.2f s with --parallel on %d GPUs)' % \
+              (baseline.elapsed * len(groups), baseline.elapsed * ((len(groups) + gpus - 1) // gpus), gpus)
 
-                enabled_counters += counter
+
+def start(catalog, selection, option_conf_file, option_cmd, option_cmd_args, option_out_pattern, option_deps_only,
+          **kwargs):
+    # Collect enabled options
+    enabled_options = selection.get_enabled_options()
+
+    # Collect enabled metrics
+    enabled_metrics = selection.get_enabled_metrics()
+
+    # Collect enabled events and the ones needed by the metrics
+    enabled_counters = selection.get_required_counters()
 
     groups = cuda.get_event_groups(enabled_counters)
 
@@ -51,24 +93,62 @@ def start(options, counters, metrics, option_conf_file, option_cmd, option_cmd_a
         for group in groups:
             print ','.join([ counter.name for counter in group ])
 
+        free_metrics = selection.get_free_metrics(enabled_counters)
+        if len(free_metrics) > 0:
+            print '# Free metrics: %s' % ','.join([ metric.name for metric in free_metrics ])
+
+        print '# %d replays (%d without packing the counter groups)' % (len(groups),
+                                                                      len(cuda.get_event_groups(enabled_counters,
+                                                                                                optimize = False)))
+
+        if kwargs.get('plan', False):
+            print_plan(option_cmd, option_cmd_args, enabled_options, groups, enabled_metrics,
+                       selection.get_enabled_counters(), **kwargs)
+
         return
 
+    if kwargs.pop('free_metrics', False):
+        # Also compute the metrics that only need the collected counters
+        free_metrics = selection.get_free_metrics(enabled_counters)
+        if len(free_metrics) > 0:
+            print "%s> Computing %d free metrics: %s" % (now(), len(free_metrics),
+                                                        ', '.join([ metric.name for metric in free_metrics ]))
+
+        enabled_metrics = enabled_metrics + free_metrics
+
     def print_progress(n):
-        i = 1
-        while i <= n:
-            print "%s> Run %d/%d" % (now(), i, n)
-            i +=1
-            yield
+        # Receives each Replay when it starts and when it finishes. Resumed sessions and the replay cache skip some
+        # groups, so runs are numbered by their group
+        while True:
+            replay = yield
+            if replay.elapsed == None:
+                print "%s> Run %d/%d" % (now(), replay.index + 1, n)
+            elif replay.get_error() != None:
+                print "%s> Run %d/%d %s" % (now(), replay.index + 1, n, replay.get_error())
+            else:
+                print "%s> Run %d/%d finished in %.2f s" % (now(), replay.index + 1, n, replay.elapsed)
 
     progress = print_progress(len(groups))
 
-    runner.launch_groups(option_cmd,
-                         option_cmd_args,
-                         enabled_options,
-                         groups,
-                         enabled_metrics,
-                         progress,
-                         out_pattern = option_out_pattern)
+    try:
+        runner.launch_groups(option_cmd,
+                             option_cmd_args,
+                             enabled_options,
+                             groups,
+                             enabled_metrics,
+                             progress,
+                             out_pattern = option_out_pattern,
+                             enabled_counters = selection.get_enabled_counters(),
+                             **kwargs)
+    except runner.ReplayError as e:
+        print "%s> %s" % (now(), e)
+        sys.exit(-1)
+
+    if len(enabled_metrics) > 0:
+        print "%s> Metric cache: %d hits, %d misses (%.1f%% hit rate)" % (now(),
+                                                                          cuda.METRIC_CACHE.hits,
+                                                                          cuda.METRIC_CACHE.misses,
+                                                                          cuda.METRIC_CACHE.hit_rate() * 100)
 
 
 # vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
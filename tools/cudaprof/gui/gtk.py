@@ -16,7 +16,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import copy
 import os
 from gi.repository import Gtk
 from gi.repository import Gdk
@@ -27,10 +26,11 @@ import cudaprof.io     as _io
 import cudaprof.runner as _runner
 
 class NotebookDomains(Gtk.Notebook):
-    def __init__(self, options, domains, metrics, parent):
+    def __init__(self, catalog, selection, parent):
         Gtk.Notebook.__init__(self)
 
-        self.parent = parent
+        self.parent    = parent
+        self.selection = selection
 
         self.checkboxes_opts = {}
         self.checkboxes = {}
@@ -44,11 +44,11 @@ class NotebookDomains(Gtk.Notebook):
         layout.add_with_viewport(grid_options)
         frame_opts.add(layout)
 
-        for option in options:
+        for option in catalog.options:
             # Create one checkbox per option
             check_counter = Gtk.CheckButton(option.name)
             check_counter.connect("toggled", self.on_option_toggled, option)
-            check_counter.set_active(option.active)
+            check_counter.set_active(selection.is_active(option))
             check_counter.set_tooltip_text(option.description)
             grid_options.add(check_counter)
 
@@ -57,24 +57,24 @@ class NotebookDomains(Gtk.Notebook):
         self.append_page(frame_opts, Gtk.Label('Options'))
         frame_opts.show()
 
-        all_domains = sorted(set(domains.keys() + metrics.keys()))
+        all_domains = sorted(set(catalog.counters.keys() + catalog.metrics.keys()))
 
         # Create one page per domain
         for domain in all_domains:
             grid_frames = Gtk.VBox()
 
-            if domain in metrics.keys():
+            if domain in catalog.metrics:
                 frame_metrics  = Gtk.Expander()
                 frame_metrics.set_expanded(True)
                 frame_metrics.set_label('Metrics')
 
                 grid_metrics = Gtk.VBox()
 
-                for metric in sorted(metrics[domain], key = lambda x: x.name):
+                for metric in sorted(catalog.get_category_metrics(domain), key = lambda x: x.name):
                     # Create one checkbox per counter
                     check_metric = Gtk.CheckButton(metric.name)
                     check_metric.connect("toggled", self.on_checkbox_toggled, metric)
-                    check_metric.set_active(metric.active)
+                    check_metric.set_active(selection.is_active(metric))
                     check_metric.set_tooltip_text(metric.description)
                     grid_metrics.add(check_metric)
 
@@ -83,18 +83,18 @@ class NotebookDomains(Gtk.Notebook):
                 frame_metrics.add(grid_metrics)
                 grid_frames.pack_start(frame_metrics, False, False, 0)
 
-            if domain in domains.keys():
+            if domain in catalog.counters:
                 expander_counters  = Gtk.Expander()
                 expander_counters.set_expanded(True)
                 expander_counters.set_label('Counters')
 
                 grid_counters = Gtk.VBox()
 
-                for counter in sorted(domains[domain], key = lambda x: x.name):
+                for counter in sorted(catalog.get_category_counters(domain), key = lambda x: x.name):
                     # Create one checkbox per counter
                     check_counter = Gtk.CheckButton(counter.name)
                     check_counter.connect("toggled", self.on_checkbox_toggled, counter)
-                    check_counter.set_active(counter.active)
+                    check_counter.set_active(selection.is_active(counter))
                     check_counter.set_tooltip_text(counter.description)
                     grid_counters.add(check_counter)
 
@@ -112,25 +112,24 @@ class NotebookDomains(Gtk.Notebook):
     def on_option_toggled(self, check_option, *data):
         assert len(data) == 1
         option = data[0]
-        option.set_active(check_option.get_active())
+        self.selection.set_active(option, check_option.get_active())
 
 
     def on_checkbox_toggled(self, check_counter, *data):
         assert len(data) == 1
         counter = data[0]
-        counter.set_active(check_counter.get_active())
+        self.selection.set_active(counter, check_counter.get_active())
 
-    def update_conf(self, options, counters):
-        for option in options:
-            self.checkboxes_opts[option.name].connect("toggled",
-                                                      self.on_option_toggled, option)
-            self.checkboxes_opts[option.name].set_active(option.active)
+    def update_conf(self, catalog):
+        # Update checkboxes with the values in the selection
+        for option in catalog.options:
+            self.checkboxes_opts[option.name].set_active(self.selection.is_active(option))
 
-        for ctrs in counters.values():
-            for counter in ctrs:
-                self.checkboxes[counter.name].connect("toggled",
-                                                      self.on_checkbox_toggled, counter)
-                self.checkboxes[counter.name].set_active(counter.active)
+        for counter in catalog.get_counters():
+            self.checkboxes[counter.name].set_active(self.selection.is_active(counter))
+
+        for metric in catalog.get_metrics():
+            self.checkboxes[metric.name].set_active(self.selection.is_active(metric))
 
 
 def get_abspath(path):
@@ -140,11 +139,17 @@ def get_abspath(path):
 
 
 class MainWindow(Gtk.Window):
-    def __init__(self, options, domains, metrics, conf_file, cmd, args, out_pattern):
+    def __init__(self, catalog, selection, conf_file, cmd, args, out_pattern, **kwargs):
         Gtk.Window.__init__(self, title="CUDA Profiler Configuration Tool")
-        self.options = copy.deepcopy(options)
-        self.domains = copy.deepcopy(domains)
-        self.metrics = copy.deepcopy(metrics)
+        # Also compute the metrics that only need the collected counters
+        self.free_metrics = kwargs.pop('free_metrics', False)
+
+        # Extra arguments for the runner
+        self.runner_kwargs = kwargs
+
+        # The catalog is shared, only the selection is copied
+        self.catalog   = catalog
+        self.selection = selection.copy()
 
         self.initialized = False
 
@@ -163,7 +168,7 @@ class MainWindow(Gtk.Window):
         self.add(self.box)
 
         # Add notebook with the counters
-        self.notebook_domains = NotebookDomains(self.options, self.domains, self.metrics, self)
+        self.notebook_domains = NotebookDomains(self.catalog, self.selection, self)
         self.box.pack_start(self.notebook_domains, True, True, 0)
 
         self.notebook_domains.set_size_request(-1, 300)
@@ -235,6 +240,11 @@ class MainWindow(Gtk.Window):
         # Add profile button
         self.button_profile = Gtk.Button('Profile')
         self.button_profile.connect("clicked", self.on_profile_clicked)
+        # Add cancel button
+        self.button_cancel = Gtk.Button('Cancel')
+        self.button_cancel.connect("clicked", self.on_cancel_clicked)
+        self.button_cancel.set_sensitive(False)
+        self.cancel_requested = False
         # Add cmd entry
         self.label_cmd  = Gtk.Label('Command')
         self.label_cmd.set_justify(Gtk.Justification.LEFT)
@@ -257,6 +267,7 @@ class MainWindow(Gtk.Window):
         self.box_out_pattern.pack_end(self.entry_out_pattern, True, True, 0)
 
         self.box_profile.pack_end(self.button_profile, False, False, 0)
+        self.box_profile.pack_end(self.button_cancel, False, False, 0)
 
         homedir = os.path.expanduser("~")
 
@@ -303,6 +314,7 @@ class MainWindow(Gtk.Window):
         self.button_load.set_size_request(100, -1)
         self.button_save.set_size_request(100, -1)
         self.button_profile.set_size_request(100, -1)
+        self.button_cancel.set_size_request(100, -1)
 
         self.layout_log.set_size_request(-1, 200)
 
@@ -412,19 +424,15 @@ class MainWindow(Gtk.Window):
         dialog.destroy()
 
     def on_load_clicked(self, button):
-        # Create counters
-        self.options = _cuda.get_options()
-        # Reset counters
-        self.domains = _cuda.get_counters(False)
+        # Reset options, counters and metrics
+        self.selection.reset()
         # Load from file
-        options_file, counters_file = _io.get_conf_from_file(self.current_conf_in)
+        options_file, counters_file, metrics_file = _io.get_conf_from_file(self.current_conf_in)
 
-        # Merge options from file
-        cudaprof.init_options(self.options, options_file)
-        # Merge counters from file
-        cudaprof.init_counters(self.domains, counters_file)
+        # Merge options, counters and metrics from file
+        self.selection.set_conf(options_file, counters_file, metrics_file)
         # Update checkboxes with the new values
-        self.notebook_domains.update_conf(self.options, self.domains)
+        self.notebook_domains.update_conf(self.catalog)
 
         buf = self.label_log.get_buffer()
         buf.insert(buf.get_start_iter(),
@@ -435,7 +443,7 @@ class MainWindow(Gtk.Window):
 
     def on_save_clicked(self, button):
         # Write to file
-        _io.put_conf_to_file(self.current_conf_out, self.options, self.domains, self.metrics)
+        _io.put_conf_to_file(self.current_conf_out, self.selection)
 
         buf = self.label_log.get_buffer()
         buf.insert(buf.get_start_iter(),
@@ -444,29 +452,18 @@ class MainWindow(Gtk.Window):
                     self.current_conf_out))
 
 
+    def on_cancel_clicked(self, button):
+        self.cancel_requested = True
+
     def on_profile_clicked(self, button):
         # Collect enabled options
-        enabled_options = [ option for option in self.options if option.active == True ]
-        # Collect enabled events
-        enabled_counters = [ counter for counters in self.domains.values()
-                                     for counter in counters if counter.active == True ]
+        enabled_options = self.selection.get_enabled_options()
 
         # Collect enabled metrics
-        enabled_metrics = [ metric for metrics in self.metrics.values()
-                                   for metric in metrics if metric.active == True ]
-
-        # Enable counters needed by the metrics
-        for metric in enabled_metrics:
-            for counter_name in metric.counters:
-                enabled_counter = [ counter for counter in enabled_counters if counter.name == counter_name ]
-
-                if len(enabled_counter) == 0:
-                    # Not enabled by default
-                    counter = [ counter for counters in self.domains.values()
-                                        for counter in counters if counter.name == counter_name ]
-                    assert len(counter) > 0, "Counter name not known"
+        enabled_metrics = self.selection.get_enabled_metrics()
 
-                    enabled_counters += counter
+        # Collect enabled events and the ones needed by the metrics
+        enabled_counters = self.selection.get_required_counters()
 
         cmd  = self.entry_cmd.get_text()
         args = self.entry_args.get_text()
@@ -475,33 +472,76 @@ class MainWindow(Gtk.Window):
         buf = self.label_log.get_buffer()
         buf.insert(buf.get_start_iter(), "%s> BEGIN PROFILE: Command: '%s %s'\n" % (now(), cmd, args))
 
+        if self.free_metrics:
+            free_metrics = self.selection.get_free_metrics(enabled_counters)
+            if len(free_metrics) > 0:
+                buf.insert(buf.get_start_iter(), "%s> Computing %d free metrics: %s\n" %
+                           (now(), len(free_metrics), ', '.join([ metric.name for metric in free_metrics ])))
+
+            enabled_metrics = enabled_metrics + free_metrics
+
         # Repaint
         while Gtk.events_pending():
             Gtk.main_iteration()
 
         # Generator to update the GUI on each execution
         def print_progress(n):
-            i = 1
-            while i <= n:
-                buf.insert(buf.get_start_iter(), "%s> Run %d/%d\n" % (now(), i, n))
+            # Receives each Replay when it starts and when it finishes (runs are numbered by their group)
+            while True:
+                replay = yield
+                if replay.elapsed == None:
+                    buf.insert(buf.get_start_iter(), "%s> Run %d/%d\n" % (now(), replay.index + 1, n))
+                elif replay.get_error() != None:
+                    buf.insert(buf.get_start_iter(), "%s> Run %d/%d %s\n" % (now(), replay.index + 1, n,
+                                                                             replay.get_error()))
+                else:
+                    buf.insert(buf.get_start_iter(), "%s> Run %d/%d finished in %.2f s\n" % (now(), replay.index + 1, n,
+                                                                                             replay.elapsed))
+
                 # Update GUI since we are in a handler
                 while Gtk.events_pending():
                     Gtk.main_iteration()
 
-                i +=1
-                yield
+        # Keep the GUI responsive while the replays run
+        def cancelled():
+            while Gtk.events_pending():
+                Gtk.main_iteration()
+
+            return self.cancel_requested
 
         progress = print_progress(len(groups))
 
-        _runner.launch_groups(self.current_cmd, args, enabled_options, groups,
-                              self.metrics, progress, out_pattern = self.current_out_pattern)
+        self.cancel_requested = False
+        self.button_profile.set_sensitive(False)
+        self.button_cancel.set_sensitive(True)
+
+        try:
+            _runner.launch_groups(self.current_cmd, args, enabled_options, groups,
+                                  enabled_metrics, progress, out_pattern = self.current_out_pattern,
+                                  enabled_counters = self.selection.get_enabled_counters(),
+                                  cancelled = cancelled,
+                                  **self.runner_kwargs)
+
+            if len(enabled_metrics) > 0:
+                metric_cache = _cuda.METRIC_CACHE
+                buf.insert(buf.get_start_iter(),
+                           "%s> Metric cache: %d hits, %d misses (%.1f%% hit rate)\n" % (now(),
+                                                                                        metric_cache.hits,
+                                                                                        metric_cache.misses,
+                                                                                        metric_cache.hit_rate() * 100))
+        except _runner.ReplayError as e:
+            buf.insert(buf.get_start_iter(), "%s> %s\n" % (now(), e))
+        finally:
+            self.button_cancel.set_sensitive(False)
+            self.button_profile.set_sensitive(os.path.isfile(self.current_cmd))
 
         buf.insert(buf.get_start_iter(), "%s> END PROFILE\n" % now())
 
 
-def start(options, counters, metrics, option_conf_file, option_cmd, option_cmd_args, option_out_pattern, option_deps_only):
+def start(catalog, selection, option_conf_file, option_cmd, option_cmd_args, option_out_pattern, option_deps_only,
+          **kwargs):
     # Create window
-    win = MainWindow(options, counters, metrics, option_conf_file, option_cmd, option_cmd_args, option_out_pattern)
+    win = MainWindow(catalog, selection, option_conf_file, option_cmd, option_cmd_args, option_out_pattern, **kwargs)
     win.connect("delete-event", Gtk.main_quit)
     win.show_all()
 
@@ -42,7 +42,7 @@ def get_conf_from_file(counter_file):
     saved_metrics  = []
 
     if counter_file == None:
-        return saved_options, saved_counters
+        return saved_options, saved_counters, saved_metrics
 
     config = ConfigParser.RawConfigParser()
     config.read(counter_file)
@@ -59,25 +59,26 @@ def get_conf_from_file(counter_file):
     return saved_options, saved_counters, saved_metrics
 
 
-def put_conf_to_file(counter_file, options, domains, metrics):
-    config = ConfigParser.RawConfigParser()
+def put_conf_to_file(counter_file, selection):
+    catalog = selection.catalog
+    config  = ConfigParser.RawConfigParser()
 
     config.add_section('Options')
 
-    for option in options:
-        config.set('Options', option.name, '%d' % option.active)
+    for option in catalog.options:
+        config.set('Options', option.name, '%d' % selection.is_active(option))
 
     config.add_section('Counters')
 
-    for name, counters in domains.items():
+    for name, counters in catalog.counters.items():
         for counter in counters:
-            config.set('Counters', counter.name, '%d' % counter.active)
+            config.set('Counters', counter.name, '%d' % selection.is_active(counter))
 
     config.add_section('Metrics')
 
-    for name, _metrics in metrics.items():
+    for name, _metrics in catalog.metrics.items():
         for metric in _metrics:
-            config.set('Metrics', metric.name, '%d' % metric.active)
+            config.set('Metrics', metric.name, '%d' % selection.is_active(metric))
 
     try:
         f_out = open(counter_file, 'wb')
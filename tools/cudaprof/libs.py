@@ -21,8 +21,26 @@ import sys
 
 from cudaprof.common import enum
 
-CUDA = None
-CUPTI = None
+class Library(object):
+    # Proxy for a shared library. CUDA and CUPTI are only loaded the first time one of their symbols or types is
+    # used, so modules can be imported without paying for (or requiring) the libraries.
+    def __init__(self, name):
+        self.name = name
+        self.lib  = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found in the proxy
+        if self.lib == None:
+            load_libraries()
+
+        return getattr(self.lib, attr)
+
+    def is_loaded(self):
+        return self.lib != None
+
+
+CUDA  = Library('libcuda.so')
+CUPTI = Library('libcupti.so')
 
 def register_cuda(f, args):
     global CUDA
@@ -90,6 +108,9 @@ def init_libcuda():
     register_cuda(CUDA.cuInit,
                   [ C.c_uint ])
 
+    register_cuda(CUDA.cuDriverGetVersion,
+                  [ C.POINTER(C.c_int) ])
+
     register_cuda(CUDA.cuDeviceGetCount,
                   [ C.POINTER(C.c_int) ])
 
@@ -108,6 +129,8 @@ def init_libcuda():
 
 def init_libcupti():
     # Interpose all needed CUPTI functions
+    register_cupti(CUPTI.cuptiGetVersion,
+                   [ C.POINTER(C.c_uint32) ])
 
     # Events
     register_cupti(CUPTI.cuptiDeviceGetNumEventDomains,
@@ -165,78 +188,85 @@ def init_libcupti():
                    ])
 
 
-def load_libraries():
-    global CUDA
-    global CUPTI
+def _register_cuda_types():
+    CUDA.context_t = C.c_void_p
+    CUDA.device_t  = C.c_int
+    CUDA.result_t  = C.c_int
 
-    try:
-        # Load libcuda
-        CUDA = C.cdll.LoadLibrary('libcuda.so')
 
-        # Register CUDA types
-        CUDA.context_t = C.c_void_p
-        CUDA.device_t  = C.c_int
-        CUDA.result_t  = C.c_int
-    except OSError:
-        print 'Could not load library libcuda.so'
-        sys.exit(-1)
+def _register_cupti_types():
+    CUPTI.result_t      = C.c_int
 
-    try:
-        # Load libcupti
-        CUPTI = C.cdll.LoadLibrary('libcupti.so')
+    CUPTI.domain_t      = C.c_uint32
+    CUPTI.domain_attr_t = C.c_int
 
-        # Register CUPTI types
-        CUPTI.result_t      = C.c_int
+    CUPTI.event_t       = C.c_uint32
+    CUPTI.event_attr_t  = C.c_int
 
-        CUPTI.domain_t      = C.c_uint32
-        CUPTI.domain_attr_t = C.c_int
+    CUPTI.metric_t      = C.c_uint32
+    CUPTI.metric_attr_t = C.c_int
 
-        CUPTI.event_t       = C.c_uint32
-        CUPTI.event_attr_t  = C.c_int
+    CUPTI.group_set     = cupti_group_set
+    CUPTI.group_sets    = cupti_group_sets
+    CUPTI.metric_value  = cupti_metric_value
 
-        CUPTI.metric_t      = C.c_uint32
-        CUPTI.metric_attr_t = C.c_int
+    CUPTI.event_collection_mode = enum(CONTINUOUS = 0,
+                                       KERNEL     = 1)
 
-        CUPTI.group_set     = cupti_group_set
-        CUPTI.group_sets    = cupti_group_sets
-        CUPTI.metric_value  = cupti_metric_value
+    CUPTI.domain_attr = enum(NAME                 = 0,
+                             INSTANCE_COUNT       = 1,
+                             TOTAL_INSTANCE_COUNT = 3)
 
-        CUPTI.event_collection_mode = enum(CONTINUOUS = 0,
-                                           KERNEL     = 1)
+    CUPTI.event_attr = enum(NAME              = 0,
+                            SHORT_DESCRIPTION = 1,
+                            LONG_DESCRIPTION  = 2,
+                            CATEGORY          = 3)
 
-        CUPTI.domain_attr = enum(NAME                 = 0,
-                                 INSTANCE_COUNT       = 1,
-                                 TOTAL_INSTANCE_COUNT = 3)
+    CUPTI.event_group_attr = enum(EVENT_DOMAIN_ID              = 0,
+                                  PROFILE_ALL_DOMAIN_INSTANCES = 1,
+                                  USER_DATA                    = 2,
+                                  NUM_EVENTS                   = 3,
+                                  EVENTS                       = 4,
+                                  INSTANCE_COUNT               = 5)
 
-        CUPTI.event_attr = enum(NAME              = 0,
-                                SHORT_DESCRIPTION = 1,
-                                LONG_DESCRIPTION  = 2,
-                                CATEGORY          = 3)
+    CUPTI.metric_attr = enum(NAME              = 0,
+                             SHORT_DESCRIPTION = 1,
+                             LONG_DESCRIPTION  = 2,
+                             CATEGORY          = 3,
+                             VALUE_KIND        = 4,
+                             EVALUATION_MODE   = 5)
 
-        CUPTI.event_group_attr = enum(EVENT_DOMAIN_ID              = 0,
-                                      PROFILE_ALL_DOMAIN_INSTANCES = 1,
-                                      USER_DATA                    = 2,
-                                      NUM_EVENTS                   = 3,
-                                      EVENTS                       = 4,
-                                      INSTANCE_COUNT               = 5)
+    CUPTI.metric_value_kind = enum(DOUBLE     = 0,
+                                   UINT64     = 1,
+                                   PERCENT    = 2,
+                                   THROUGHPUT = 3)
 
-        CUPTI.metric_attr = enum(NAME              = 0,
-                                 SHORT_DESCRIPTION = 1,
-                                 LONG_DESCRIPTION  = 2,
-                                 CATEGORY          = 3,
-                                 VALUE_KIND        = 4,
-                                 EVALUATION_MODE   = 5)
+    CUPTI.metric_evaluation_mode = enum(PER_INSTANCE = 1,
+                                        AGGREGATE    = 1 << 1)
 
-        CUPTI.metric_value_kind = enum(DOUBLE     = 0,
-                                       UINT64     = 1,
-                                       PERCENT    = 2,
-                                       THROUGHPUT = 3)
 
-        CUPTI.metric_evaluation_mode = enum(PER_INSTANCE = 1,
-                                            AGGREGATE    = 1 << 1)
+def load_libraries():
+    if CUDA.is_loaded() and CUPTI.is_loaded():
+        return
 
+    try:
+        # Load libcuda
+        CUDA.lib = C.cdll.LoadLibrary(CUDA.name)
+
+        # Register CUDA types
+        _register_cuda_types()
+    except OSError:
+        print 'Could not load library %s' % CUDA.name
+        sys.exit(-1)
+
+    try:
+        # Load libcupti
+        CUPTI.lib = C.cdll.LoadLibrary(CUPTI.name)
+
+        # Register CUPTI types
+        _register_cupti_types()
     except OSError:
-        print 'Could not load library libcupti.so'
+        print 'Could not load library %s' % CUPTI.name
         sys.exit(-1)
 
     # Register functions in the libraries
@@ -244,8 +274,28 @@ def load_libraries():
     init_libcupti()
 
 
-# Load libraries into memory
-load_libraries()
+def is_available():
+    # True if libcuda and libcupti can be loaded (e.g. to only use CUPTI when it is installed)
+    if CUDA.is_loaded() and CUPTI.is_loaded():
+        return True
+
+    try:
+        C.cdll.LoadLibrary(CUDA.name)
+        C.cdll.LoadLibrary(CUPTI.name)
+    except OSError:
+        return False
+
+    return True
+
+
+def load_stub_libraries(cuda, cupti):
+    # Use the given objects instead of libcuda and libcupti (e.g. to run without a GPU). They must provide the
+    # functions used by the tools, taking the same arguments as the (registered) functions of the libraries
+    CUDA.lib  = cuda
+    CUPTI.lib = cupti
+
+    _register_cuda_types()
+    _register_cupti_types()
 
 
 # vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -0,0 +1,309 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import struct
+
+import numpy
+
+from cudaprof.table import COLUMN_KINDS
+
+# Number of lines used to infer the type of each column
+SAMPLE_LINES = 256
+
+# Number of offsets converted at once to Python values when iterating over the rows
+ITER_CHUNK_LINES = 4096
+
+# Size of the blocks scanned at once when looking for line breaks
+INDEX_BLOCK_SIZE = 1 << 24
+
+# Header of the index files: magic, size and modification time of the log file
+INDEX_MAGIC  = 'CUDAPROFIDX1'
+INDEX_HEADER = struct.Struct('<12sQd')
+
+# Columns with hexadecimal timestamps, which are kept as text (see get_timestamp)
+TIMESTAMP_COLUMNS = [ 'gpustarttimestamp', 'gpuendtimestamp' ]
+
+
+def num(s):
+    try:
+        return long(s)
+    except ValueError:
+        try:
+            return float(s)
+        except ValueError:
+            return s
+
+
+_NUMBER_CHARS = '0123456789+-.eE \t\r\n'
+_FLOAT_WORDS  = [ 'inf', 'infinity', 'nan' ]
+
+
+def get_timestamp(value):
+    # Value (in ns) of a gpustarttimestamp/gpuendtimestamp field, which are hexadecimal (-1 if not available)
+    if isinstance(value, str):
+        try:
+            return int(value, 16)
+        except ValueError:
+            return -1
+
+    return -1
+
+
+# Converters used for the columns of each inferred type. They return the same values as num(), but only fall back
+# to it (and its exceptions) for the values that do not have the type of their column
+def _to_long(s):
+    try:
+        return long(s)
+    except ValueError:
+        return num(s)
+
+
+def _to_float(s):
+    if '.' in s:
+        try:
+            return float(s)
+        except ValueError:
+            return s
+
+    return num(s)
+
+
+def _to_str(s):
+    # Besides the characters of numbers, float() only accepts inf, infinity and nan
+    letters = s.translate(None, _NUMBER_CHARS)
+    if len(letters) > 0 and letters.lower() not in _FLOAT_WORDS:
+        return s
+
+    return num(s)
+
+
+_CONVERTERS = { COLUMN_KINDS.INT     : _to_long,
+                COLUMN_KINDS.FLOAT   : _to_float,
+                COLUMN_KINDS.CATEGORY: _to_str,
+                None                 : num }
+
+
+def _infer_kind(values):
+    # Kind of the column (see table.py) with the given sample of fields (None if the sample is empty)
+    types = set(type(num(value)) for value in values)
+
+    if len(types) == 0:
+        return None
+    elif types <= set([ int, long ]):
+        return COLUMN_KINDS.INT
+    elif types <= set([ int, long, float ]):
+        return COLUMN_KINDS.FLOAT
+
+    return COLUMN_KINDS.CATEGORY
+
+
+class ProfileLog(object):
+    # Reader of the logs written by the CUDA command line profiler (cuda_profile_%p_%d.log). The file is
+    # memory-mapped, the header is parsed once and the kind of each column is inferred from a sample of lines. The
+    # offsets of the data lines (comment and empty lines are skipped) are stored in a sidecar index file
+    # (file_name.idx), so any row can be read without scanning the file again. Rows have the same values as num()
+    # would return for each field, padded with -1 (e.g. memory transfers do not have counter values)
+    def __init__(self, file_name, sidecar = True):
+        self.file_name = file_name
+
+        self.map      = None
+        self.columns  = []
+        self.comments = []
+        self.offsets  = numpy.zeros(0, dtype = numpy.int64)
+
+        self.kinds      = []
+        self.converters = []
+
+        f = open(file_name, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            if stat.st_size > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if self.map == None:
+            return
+
+        data_start = self._read_header()
+        if data_start == None:
+            return
+
+        self.offsets = None
+        if sidecar:
+            self.offsets = self._load_index(stat)
+
+        if self.offsets is None:
+            self.offsets = self._build_index(data_start)
+
+            if sidecar:
+                self._store_index(stat)
+
+        sample = [ self.get_line(n).split(',') for n in range(min(SAMPLE_LINES, len(self.offsets))) ]
+
+        for i, column in enumerate(self.columns):
+            if column in TIMESTAMP_COLUMNS:
+                # Never converted to numbers, since hexadecimal values may look like decimal or float ones
+                self.kinds.append(COLUMN_KINDS.CATEGORY)
+                self.converters.append(str)
+            else:
+                kind = _infer_kind([ fields[i] for fields in sample if len(fields) > i ])
+                self.kinds.append(kind)
+                self.converters.append(_CONVERTERS[kind])
+
+    def _read_header(self):
+        # Reads the comments and the column names. Returns the offset of the first data line (if any)
+        pos = 0
+        size = len(self.map)
+
+        while pos < size:
+            end = self.map.find('\n', pos)
+            if end == -1:
+                end = size
+
+            line = self.map[pos:end]
+            pos = end + 1
+
+            if len(line) == 0:
+                continue
+            elif line[0] == '#':
+                self.comments.append(line)
+            else:
+                self.columns = line.split(',')
+                return pos
+
+        return None
+
+    def _build_index(self, data_start):
+        buf = numpy.frombuffer(self.map, dtype = numpy.uint8)
+        size = len(buf)
+
+        # Offsets of the line breaks, scanned in blocks to bound the memory used by the comparisons
+        breaks = [ numpy.flatnonzero(buf[start:start + INDEX_BLOCK_SIZE] == ord('\n')) + start
+                   for start in range(data_start, size, INDEX_BLOCK_SIZE) ]
+
+        starts = numpy.concatenate([ numpy.array([ data_start ], dtype = numpy.int64) ] +
+                                   [ block.astype(numpy.int64) + 1 for block in breaks ])
+        starts = starts[starts < size]
+
+        # Skip empty and comment lines
+        first = buf[starts]
+
+        return starts[(first != ord('\n')) & (first != ord('#'))]
+
+    def get_index_file_name(self):
+        return self.file_name + '.idx'
+
+    def _load_index(self, stat):
+        try:
+            f = open(self.get_index_file_name(), 'rb')
+        except IOError:
+            return None
+
+        try:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                return None
+
+            magic, size, mtime = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or size != stat.st_size or mtime != stat.st_mtime:
+                # Stale index
+                return None
+
+            return numpy.frombuffer(f.read(), dtype = '<i8').astype(numpy.int64)
+        finally:
+            f.close()
+
+    def _store_index(self, stat):
+        try:
+            f = open(self.get_index_file_name(), 'wb')
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime))
+            f.write(self.offsets.astype('<i8').tostring())
+            f.close()
+        except (IOError, OSError):
+            # The index is only an optimization
+            pass
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for chunk in range(0, len(self.offsets), ITER_CHUNK_LINES):
+            for start in self.offsets[chunk:chunk + ITER_CHUNK_LINES].tolist():
+                yield self._parse(self._get_line(start))
+
+    def iter_fields(self, columns):
+        # Text of the given columns in each data line, without converting it
+        indexes = [ self.columns.index(column) for column in columns ]
+
+        for chunk in range(0, len(self.offsets), ITER_CHUNK_LINES):
+            for start in self.offsets[chunk:chunk + ITER_CHUNK_LINES].tolist():
+                fields = self._get_line(start).split(',')
+                yield [ fields[i] if i < len(fields) else '' for i in indexes ]
+
+    def get_line(self, n):
+        # Text of the n-th data line
+        return self._get_line(int(self.offsets[n]))
+
+    def _get_line(self, start):
+        end = self.map.find('\n', start)
+        if end == -1:
+            end = len(self.map)
+
+        return self.map[start:end]
+
+    def row(self, n):
+        # Values of the n-th data line (e.g. the n-th kernel invocation or memory transfer)
+        return self._parse(self.get_line(n))
+
+    def row_fields(self, n):
+        # Text of the fields of the n-th data line, padded as in row()
+        return self._split(self.get_line(n))
+
+    def iter_row_fields(self):
+        for chunk in range(0, len(self.offsets), ITER_CHUNK_LINES):
+            for start in self.offsets[chunk:chunk + ITER_CHUNK_LINES].tolist():
+                yield self._split(self._get_line(start))
+
+    def _split(self, line):
+        fields = line.split(',')
+
+        if len(fields) < len(self.columns):
+            fields += [ '-1' ] * (len(self.columns) - len(fields))
+        elif len(fields) > len(self.columns):
+            del fields[len(self.columns):]
+
+        return fields
+
+    def _parse(self, line):
+        records = [ converter(field) for converter, field in zip(self.converters, line.split(',')) ]
+
+        if len(records) < len(self.columns):
+            records += [-1] * (len(self.columns) - len(records))
+
+        return records
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -17,23 +17,31 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import glob
+import hashlib
+import itertools
+import json
 import os
 import sys
 import subprocess as proc
 import tempfile
+import threading
+import time
 
 import shutil
 
-import cudaprof.cuda as cuda
+import numpy
 
-def num(s):
-    try:
-        return long(s)
-    except ValueError:
-        try:
-            return float(s)
-        except ValueError:
-            return s
+import cudaprof.align    as align
+import cudaprof.archive  as archive
+import cudaprof.cache    as cache
+import cudaprof.columnar as columnar
+import cudaprof.cuda     as cuda
+import cudaprof.summary  as summary
+import cudaprof.timeline as timeline
+from cudaprof.common import enum
+from cudaprof.log import ProfileLog, num
+from cudaprof.sampling import RowFilter
+from cudaprof.table import Column, MISSING, ProfileTable
 
 def _get_elem(f, container):
     for elem in container:
@@ -42,73 +50,253 @@ def _get_elem(f, container):
 
     return None
 
-def merge_files(input_files):
-    columns = []
+# Method name of each of the nrows merged rows (rows missing in some logs take it from the first log that has them).
+# Logs without a method column (e.g. the empty log of a crashed replay) are skipped
+def _get_methods(logs, lines, nrows):
+    method_logs = [ log for log in logs if 'method' in log.columns ]
+
+    if len(method_logs) == 0:
+        return itertools.repeat('', nrows)
+
+    if lines == None:
+        return (fields[0] for fields in method_logs[0].iter_fields([ 'method' ]))
+
+    methods = [ None ] * len(lines[0])
+
+    for log, log_lines in zip(logs, lines):
+        if 'method' not in log.columns:
+            continue
+
+        log_methods = [ fields[0] for fields in log.iter_fields([ 'method' ]) ]
+
+        for row, line in enumerate(log_lines.tolist()):
+            if line >= 0 and methods[row] == None:
+                methods[row] = log_methods[line]
+
+    return [ method if method != None else '' for method in methods ]
+
+
+# Aligns the logs and applies the row filter (if any). Returns the lines of each log that go into each merged row
+# (see align.align_logs), or None if all the lines are merged one by one, and the AlignmentStats
+def _get_lines(logs, row_filter):
+    lines, stats = align.align_logs(logs)
+
+    if row_filter != None and row_filter.is_enabled():
+        rows = row_filter.select(_get_methods(logs, lines, stats.nrows))
 
-    files_data = {}
-    column_to_file_map = {}
+        if lines == None:
+            lines = [ rows ] * len(logs)
+        else:
+            lines = [ log_lines[rows] for log_lines in lines ]
+
+    return lines, stats
+
+
+def _read_table(log, lines):
+    if lines is None:
+        return ProfileTable.from_fields(log.columns, log.iter_row_fields(), log.converters, log.kinds)
+
+    # Parse only the selected lines
+    present = lines >= 0
+    table = ProfileTable.from_fields(log.columns, (log.row_fields(line) for line in lines[present].tolist()),
+                                     log.converters, log.kinds)
+
+    if present.all():
+        return table
+
+    positions = numpy.empty(len(lines), dtype = numpy.int64)
+    positions.fill(-1)
+    positions[present] = numpy.arange(table.nlines, dtype = numpy.int64)
+
+    return table.take(positions)
+
+
+# Merges the logs of the replays of a program. Rows are aligned across logs (see align.py), so logs with a different
+# number of rows yield missing cells instead of failing. Only the rows selected by row_filter (a RowFilter) are
+# parsed. Returns a ProfileTable and the AlignmentStats
+def merge_files(input_files, row_filter = None):
+    # The logs are read only once, so no index files are kept
+    logs = [ ProfileLog(_f, sidecar = False) for _f in input_files ]
+
+    lines, stats = _get_lines(logs, row_filter)
+
+    columns = []
+    column_map = {}
 
-    data = {}
-    nlines = 0
+    nlines = stats.nrows if lines == None else len(lines[0])
 
     # Iterate per input file
-    for _f in input_files:
-        f = open(_f, 'r')
-        file_columns = []
+    for n, log in enumerate(logs):
+        table = _read_table(log, lines[n] if lines != None else None)
+        log.close()
 
-        lines_data = []
+        # Find new columns
+        for column in log.columns:
+            if column not in column_map:
+                column_map[column] = table[column]
+                columns.append(column)
+            elif lines != None:
+                # Columns shared by several logs (e.g. method or gputime) take the values of the rows missing in the
+                # previous logs from this one
+                merged = column_map[column]
+                fill = [ line for line in merged.get_missing() if lines[n][line] >= 0 ]
 
-        # Parse all lines
-        for line in f.readlines():
-            line = line[:-1]
-            if line[0] == '#':
-                continue
+                if len(fill) > 0:
+                    merged.update(fill, [ table[column][line] for line in fill ])
 
-            # Read colum names
-            if len(file_columns) == 0:
-                file_columns = line.split(',')
+    # Merge the columns of all files (without copying them)
+    return ProfileTable(columns, [ column_map[column] for column in columns ], nlines), stats
 
-                # Find new columns
-                for i, column in zip(range(len(file_columns)), file_columns):
-                    if column not in columns:
-                        column_to_file_map[column] = (_f, i)
-                        columns.append(column)
 
-            else: # Read colum data
-                records = [ num(record) for record in line.split(',') ]
+# Streaming version of merge_files. If all the rows of the logs are merged one by one, the logs are read in lockstep,
+# so only the current line of each file is kept in memory. Otherwise, the selected rows are read from each log by
+# their offset. Returns the merged column names, a generator of merged rows (values in column order) and the
+# AlignmentStats
+def merge_files_streaming(input_files, row_filter = None):
+    columns, converters, kinds, rows, stats = _merge_fields_streaming(input_files, row_filter)
 
-                if len(records) < len(file_columns):
-                    records += [-1] * (len(file_columns) - len(records))
+    values = ([ converter(field) for converter, field in zip(converters, fields) ] for fields in rows)
 
-                lines_data.append(records)
+    return columns, values, stats
 
-        files_data[_f] = lines_data
 
-        if nlines == 0:
-            nlines = len(lines_data)
+# Same as merge_files_streaming, but the merged rows have the text of the fields. Also returns the converter and
+# kind of each column (see ProfileLog)
+def _merge_fields_streaming(input_files, row_filter):
+    columns = []
+    converters = []
+    kinds = []
+
+    # Location (file, field) of each column in the logs that have it
+    column_sources = []
+
+    logs = [ ProfileLog(_f, sidecar = False) for _f in input_files ]
+
+    lines, stats = _get_lines(logs, row_filter)
+
+    # Read the header of each file
+    for n, log in enumerate(logs):
+        # Find new columns
+        for i, column in enumerate(log.columns):
+            if column not in columns:
+                columns.append(column)
+                converters.append(log.converters[i])
+                kinds.append(log.kinds[i])
+                column_sources.append([])
+
+            column_sources[columns.index(column)].append((n, i))
+
+    column_to_file_map = [ sources[0] for sources in column_sources ]
+
+    def rows():
+        if lines == None:
+            for lines_data in itertools.izip(*[ log.iter_row_fields() for log in logs ]):
+                yield [ lines_data[f][c] for f, c in column_to_file_map ]
         else:
-            assert nlines == len(lines_data), 'Corrupted data'
+            # Shared columns are taken from the first log that has the row. Location of each column for each
+            # combination of logs that have the row
+            present_maps = {}
 
-    # Merge results for each line
-    for i in range(nlines):
-        for column in columns:
-            f, c = column_to_file_map[column]
-            #out_data.append(files_data[f][i][c])
+            for log_lines in itertools.izip(*[ log_lines.tolist() for log_lines in lines ]):
+                present = tuple(line >= 0 for line in log_lines)
 
-            if not data.has_key(column):
-                data[column] = list()
+                present_map = present_maps.get(present)
+                if present_map == None:
+                    present_map = [ _get_elem(lambda source: present[source[0]], sources) or sources[0]
+                                    for sources in column_sources ]
+                    present_maps[present] = present_map
 
-            data[column].append(files_data[f][i][c])
+                lines_data = [ log.row_fields(line) if line >= 0 else [ MISSING ] * len(log.columns)
+                               for log, line in zip(logs, log_lines) ]
 
-    return columns, data, nlines
+                yield [ lines_data[f][c] for f, c in present_map ]
 
+        for log in logs:
+            log.close()
 
-def launch_group(cmd, args, options, group, **kwargs):
-    csv      = kwargs.get('csv', True)
-    out_dir  = kwargs.get('out_dir', './')
-    out_file = out_dir + '/cuda_profile_%p_%d.log'
+    return columns, converters, kinds, rows(), stats
+
+
+# Formats of the output files: text (CSV), binary columnar (see columnar.py) or both
+OUTPUT_FORMATS = enum(CSV  = 'csv',
+                      BIN  = 'bin',
+                      BOTH = 'both')
+
+# Number of lines processed at once when merging in streaming mode
+STREAM_CHUNK_LINES = 1024
+
+# Number of lines converted at once to Python values when writing the output
+WRITE_CHUNK_LINES = 4096
+
+# Interval (in seconds) between checks for finished replays
+POLL_INTERVAL = 0.1
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplayFailed(ReplayError):
+    # Some replays timed out or exited with an error (replays are the failed Replays)
+    def __init__(self, replays):
+        ReplayError.__init__(self, '; '.join([ 'Run %d %s' % (replay.index + 1, replay.get_error())
+                                               for replay in replays ]))
+        self.replays = replays
+
+
+class ReplayCancelled(ReplayError):
+    pass
+
+
+class Replay(object):
+    # Execution of the program to collect one group of counters
+    def __init__(self, index, group, worker, log_dir):
+        self.index   = index
+        self.group   = group
+        self.worker  = worker
+        self.log_dir = log_dir
+
+        self.pid        = None
+        self.returncode = None
+        self.timed_out  = False
+        self.start      = None
+        self.elapsed    = None
+
+        self.process = None
+        self.conf    = None
+        self.outputs = []
+        self.tees    = []
+
+    def get_error(self):
+        # Why the replay failed, or None if it succeeded
+        if self.timed_out:
+            return 'timed out after %.2f s' % self.elapsed
+        elif self.returncode != 0:
+            return 'failed with exit code %d' % self.returncode
 
-    lines = len(options) + len(group)
+        return None
+
+    def get_output_files(self):
+        return (self.log_dir + ('/replay.%d.stdout' % self.index),
+                self.log_dir + ('/replay.%d.stderr' % self.index))
+
+
+def _tee(pipe, f, stream):
+    # Copy the output of the program both to its file and to the terminal
+    for line in iter(pipe.readline, ''):
+        f.write(line)
+        stream.write(line)
+
+    pipe.close()
+
+
+def _start_group(cmd, args, options, replay, csv, device = None, tee = False):
+    out_file = replay.log_dir + '/cuda_profile_%p_%d.log'
+
+    lines = len(options) + len(replay.group)
+
+    # Each replay gets its own copy of the environment
+    env = dict(os.environ)
 
     if lines > 0:
         # Fill config file
@@ -119,38 +307,496 @@ def launch_group(cmd, args, options, group, **kwargs):
         for option in options:
             f.write('%s\n' % option)
 
-        for counter in group:
+        for counter in replay.group:
             f.write('%s\n' % counter.name)
 
         f.close()
 
-        os.environ['COMPUTE_PROFILE_CONFIG'] = f_name
+        env['COMPUTE_PROFILE_CONFIG'] = f_name
+        replay.conf = f_name
 
     # Modify the environment
-    os.environ['COMPUTE_PROFILE']     = '1'
-    os.environ['COMPUTE_PROFILE_CSV'] = '%d' % csv
-    os.environ['COMPUTE_PROFILE_LOG'] = out_file
+    env['COMPUTE_PROFILE']     = '1'
+    env['COMPUTE_PROFILE_CSV'] = '%d' % csv
+    env['COMPUTE_PROFILE_LOG'] = out_file
+
+    if device != None:
+        # Pin the replay to a single GPU
+        env['CUDA_VISIBLE_DEVICES'] = '%d' % device
+
+    # The output of the program goes to files, so it never blocks on a full pipe
+    replay.outputs = [ open(f_name, 'w') for f_name in replay.get_output_files() ]
+
+    if tee:
+        out = proc.PIPE
+        err = proc.PIPE
+    else:
+        out, err = replay.outputs
 
     # Execute the program
-    p = proc.Popen([cmd] + args.split(' '),
-                   stdout = proc.PIPE,
-                   stderr = proc.PIPE,
-                   env = os.environ)
-    pid = p.pid
-    p.wait()
+    replay.start   = time.time()
+    replay.process = proc.Popen([cmd] + args.split(' '),
+                                stdout = out,
+                                stderr = err,
+                                env = env)
+    replay.pid = replay.process.pid
 
-    if lines > 0:
+    if tee:
+        for pipe, f, stream in zip([ replay.process.stdout, replay.process.stderr ], replay.outputs,
+                                   [ sys.stdout, sys.stderr ]):
+            thread = threading.Thread(target = _tee, args = (pipe, f, stream))
+            thread.daemon = True
+            thread.start()
+            replay.tees.append(thread)
+
+
+def _finish_group(replay):
+    replay.elapsed = time.time() - replay.start
+
+    for thread in replay.tees:
+        thread.join()
+
+    for f in replay.outputs:
+        f.close()
+
+    if replay.conf != None:
         # Remove temporary file
         try:
-            os.remove(f_name)
+            os.remove(replay.conf)
         except OSError:
-            print 'Error removing temporary file for conf "%s"' % f_name
+            print 'Error removing temporary file for conf "%s"' % replay.conf
+
+
+def _kill_group(replay):
+    try:
+        replay.process.kill()
+    except OSError:
+        # The process already finished
+        pass
+
+    replay.process.wait()
+    _finish_group(replay)
+
+
+def launch_group(cmd, args, options, group, **kwargs):
+    device = kwargs.get('device', None)
+
+    replays = launch_groups_parallel(cmd, args, options, [ group ], [ device ], **kwargs)
+
+    return replays[0].pid
+
+
+# Replay the counter groups concurrently, with one worker slot per device (None to use all the GPUs). Each worker
+# is pinned to its device through CUDA_VISIBLE_DEVICES and writes its logs into its own directory, or each group
+# into its own directory (out_dir/group.N) if group_dirs is True. indexes are the numbers of the groups in the
+# session (by default, their position in groups). Progress is reported by sending the Replay object to the progress
+# generator when the replay starts and when it finishes (once elapsed is set). Replays that run longer than timeout
+# seconds are killed and finish with timed_out set, while the other groups go on. The whole session is cancelled as
+# soon as the cancelled function returns True. The finished function (if any) is called with each finished Replay,
+# whether it failed or not (see Replay.get_error). Returns the Replay of each group, in the same order as groups
+def launch_groups_parallel(cmd, args, options, groups, devices, progress = None, **kwargs):
+    assert len(devices) > 0, 'No devices available'
+
+    csv        = kwargs.get('csv', True)
+    out_dir    = kwargs.get('out_dir', './')
+    tee        = kwargs.get('tee', False)
+    timeout    = kwargs.get('timeout', None)
+    cancelled  = kwargs.get('cancelled', None)
+    finished   = kwargs.get('finished', None)
+    indexes    = kwargs.get('indexes', range(len(groups)))
+    group_dirs = kwargs.get('group_dirs', False)
+
+    replays = [ None ] * len(groups)
+
+    pending = list(enumerate(groups))
+    running = {}
+
+    if progress != None:
+        # Start the progress generator
+        progress.next()
+
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            # Hand pending groups to idle workers
+            for worker, device in enumerate(devices):
+                if worker in running or len(pending) == 0:
+                    continue
+
+                i, group = pending.pop(0)
+
+                if group_dirs:
+                    log_dir = out_dir + ('/group.%d' % indexes[i])
+                elif len(devices) > 1:
+                    log_dir = out_dir + ('/worker.%d' % worker)
+                else:
+                    log_dir = out_dir
+
+                if not os.path.isdir(log_dir):
+                    os.mkdir(log_dir)
+                elif group_dirs:
+                    # Logs of a previous (failed or interrupted) replay of the group
+                    for f_name in glob.glob(log_dir + '/cuda_profile_*.log'):
+                        os.remove(f_name)
+
+                replay = Replay(indexes[i], group, worker, log_dir)
+                _start_group(cmd, args, options, replay, csv, device, tee)
+                running[worker] = (i, replay)
+
+                # Report progress
+                if progress != None:
+                    progress.send(replay)
+
+            # Collect finished replays
+            for worker, (i, replay) in running.items():
+                replay.returncode = replay.process.poll()
+
+                if replay.returncode == None and timeout != None and time.time() - replay.start > timeout:
+                    _kill_group(replay)
+                    replay.returncode = replay.process.returncode
+                    replay.timed_out  = True
+                elif replay.returncode != None:
+                    _finish_group(replay)
+
+                if replay.returncode != None:
+                    replays[i] = replay
+                    del running[worker]
+
+                    if finished != None:
+                        finished(replay)
+
+                    # Report the time taken by the replay
+                    if progress != None:
+                        progress.send(replay)
+
+            if cancelled != None and cancelled():
+                raise ReplayCancelled('Profiling cancelled')
+
+            if len(running) > 0:
+                time.sleep(POLL_INTERVAL)
+
+    except KeyboardInterrupt:
+        raise ReplayCancelled('Profiling cancelled')
+
+    finally:
+        # Stop the replays still running (if any)
+        for i, replay in running.values():
+            _kill_group(replay)
+
+    return replays
+
+
+# Group the rows returned by _merge_fields_streaming into tables with (at most) nlines lines each. Always yields at
+# least one (maybe empty) table
+def _get_chunks(columns, converters, kinds, rows, nlines):
+    while True:
+        table = ProfileTable.from_fields(columns, itertools.islice(rows, nlines), converters, kinds)
+        yield table
+
+        if table.nlines < nlines:
+            break
+
+
+def _write_lines(f, columns, data, metric_values):
+    for start in range(0, data.nlines, WRITE_CHUNK_LINES):
+        stop = min(start + WRITE_CHUNK_LINES, data.nlines)
+
+        # Get the Python values of each column for this chunk of lines
+        values = []
+        for k in columns:
+            if k in data:
+                values.append(data[k].tolist(start, stop))
+            elif isinstance(metric_values[k], Column):
+                values.append(metric_values[k].tolist(start, stop))
+            else:
+                values.append(metric_values[k][start:stop].tolist())
+
+        for row in zip(*values):
+            records = [ str(record) for record in row ]
+
+            f.write(','.join(records) + '\n')
+
+
+# Marks the values of a metric as missing in the lines where any of its inputs is missing (see align.py)
+def _mask_missing_metrics(data, metrics, metric_values):
+    for metric in metrics:
+        missing = set()
+
+        for column in [ 'gputime' ] + [ counter.name for counter in metric.counters ]:
+            if column in data:
+                missing.update(data[column].get_missing())
+
+        if len(missing) > 0:
+            metric_values[metric.name] = Column.from_array(metric_values[metric.name],
+                                                           dict.fromkeys(missing, MISSING))
+
+
+SESSION_MANIFEST = 'session.json'
+SESSION_VERSION  = 1
+
+
+class Session(object):
+    # Persistent directory with the logs of the replays of a profiling session. The manifest records the profiled
+    # program and, for each completed group, its counters and the location of its logs (relative to the session
+    # directory). It is updated as soon as each replay finishes, so an interrupted session can be resumed by
+    # replaying only the missing groups
+    def __init__(self, path, cmd, args, options):
+        self.path = path
+        self.key  = { 'cmd'    : cmd,
+                      'args'   : args,
+                      'options': [ '%s' % option for option in options ] }
+
+        self.groups = {}
+
+    def get_manifest_path(self):
+        return self.path + '/' + SESSION_MANIFEST
+
+    def open(self, resume):
+        f_name = self.get_manifest_path()
+
+        if not os.path.isfile(f_name):
+            self.store()
+            return
+
+        if not resume:
+            raise ReplayError('Session %s already exists (use --resume to continue it)' % self.path)
+
+        try:
+            f = open(f_name)
+            manifest = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            raise ReplayError('Error reading session manifest %s' % f_name)
+
+        if manifest.get('version') != SESSION_VERSION or manifest.get('key') != self.key:
+            raise ReplayError('Session %s was created for a different program, arguments or options' % self.path)
+
+        for entry in manifest['groups']:
+            self.groups[tuple(entry['counters'])] = entry
+
+    def store(self):
+        manifest = { 'version': SESSION_VERSION,
+                     'key'    : self.key,
+                     'groups' : self.groups.values() }
+
+        # Write to a temporary file and rename it, so the manifest is never left half-written
+        _f, f_name = tempfile.mkstemp(dir = self.path)
+        f = os.fdopen(_f, 'w')
+        json.dump(manifest, f, indent = 1)
+        f.close()
+
+        os.rename(f_name, self.get_manifest_path())
+
+    def add(self, replay):
+        if replay.returncode != 0:
+            # Failed replays (e.g. killed by the OOM killer) are replayed when the session is resumed
+            return
+
+        counters = [ counter.name for counter in replay.group ]
+
+        self.groups[tuple(counters)] = { 'counters': counters,
+                                         'log_dir' : os.path.relpath(replay.log_dir, self.path),
+                                         'pid'     : replay.pid,
+                                         'elapsed' : replay.elapsed }
+        self.store()
+
+    def get(self, group):
+        # Logs of a completed group: (log_dir, pid), or None if the group has to be replayed
+        entry = self.groups.get(tuple(counter.name for counter in group))
+        if entry == None:
+            return None
+
+        log_dir = os.path.normpath(self.path + '/' + entry['log_dir'])
+        if len(glob.glob(log_dir + '/cuda_profile_%d_*.log' % entry['pid'])) == 0:
+            return None
+
+        return (log_dir, entry['pid'])
+
+
+# Environment variables that may change the execution of the profiled program
+REPLAY_CACHE_ENV = [ 'CUDA_VISIBLE_DEVICES', 'LD_LIBRARY_PATH', 'LD_PRELOAD' ]
+
+
+def _get_executable_key(cmd):
+    # Hash of the contents of the program (None if it cannot be found)
+    if os.path.dirname(cmd) == '':
+        paths = os.environ.get('PATH', '').split(os.pathsep)
+    else:
+        paths = [ '' ]
+
+    for path in paths:
+        f_name = os.path.join(path, cmd)
+        if os.path.isfile(f_name):
+            break
+    else:
+        return None
+
+    h = hashlib.sha1()
+
+    try:
+        f = open(f_name, 'rb')
+        for block in iter(lambda: f.read(1 << 20), ''):
+            h.update(block)
+        f.close()
+    except IOError:
+        return None
+
+    return h.hexdigest()
+
+
+class ReplayCache(object):
+    # Persistent cache with the profiler logs of previous replays. Entries are addressed by the contents of the
+    # program, its arguments and environment, the profiler options and the counters of the group, so a replay is
+    # only reused when it would collect exactly the same data. pinned is True if the replays are pinned to a single
+    # GPU (see launch_groups_parallel), since they only write the log of that GPU
+    def __init__(self, cmd, args, options, pinned = False):
+        self.path = os.path.join(cache.get_cache_dir(), 'replays')
+
+        executable = _get_executable_key(cmd)
+        if executable != None:
+            env = [ (var, os.environ.get(var)) for var in REPLAY_CACHE_ENV ]
+            self.key = (executable, args, env, [ '%s' % option for option in options ], pinned)
+        else:
+            self.key = None
+
+    def _get_dir(self, group):
+        return os.path.join(self.path, cache.get_key(self.key, [ counter.name for counter in group ]))
+
+    def get(self, group):
+        # Logs of a cached group: (log_dir, pid), or None if the group has to be replayed
+        if not cache.ENABLED or self.key == None:
+            return None
+
+        log_dir = self._get_dir(group)
+        if len(glob.glob(log_dir + '/cuda_profile_0_*.log')) == 0:
+            return None
+
+        return (log_dir, 0)
+
+    def add(self, replay):
+        if not cache.ENABLED or self.key == None or replay.returncode != 0:
+            return
+
+        log_dir = self._get_dir(replay.group)
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            # Copy the logs to a temporary directory and rename it, so readers never see partial entries
+            tempdir = tempfile.mkdtemp(dir = self.path)
+
+            for f_name in glob.glob(replay.log_dir + '/cuda_profile_%d_*.log' % replay.pid):
+                gpu = f_name[f_name.rindex('_') + 1:-len('.log')]
+                shutil.copyfile(f_name, tempdir + ('/cuda_profile_0_%s.log' % gpu))
+
+            if os.path.isdir(log_dir):
+                shutil.rmtree(log_dir)
+            os.rename(tempdir, log_dir)
+        except (IOError, OSError):
+            print 'Error writing replay cache entry to %s' % self.path
 
-    return pid
 
 def launch_groups(cmd, args, options, groups, metrics, progress = None, **kwargs):
     assert len(groups) > 0, 'Empty counter group'
 
+    csv              = kwargs.get('csv', True)
+    devices          = kwargs.get('devices', None)
+    tee              = kwargs.get('tee', False)
+    timeout          = kwargs.get('timeout', None)
+    cancelled        = kwargs.get('cancelled', None)
+    session_dir      = kwargs.get('session', None)
+    resume           = kwargs.get('resume', False)
+    replay_cache     = kwargs.get('replay_cache', False)
+
+    pid = os.getpid()
+
+    if session_dir != None:
+        # Logs are kept in the session directory
+        tempdir = os.path.abspath(session_dir)
+    else:
+        # Create temporary output directory
+        tempdir = tempfile.gettempdir() + ('/cuda-profiler-tools.%d' % pid)
+
+    if not os.path.isdir(tempdir):
+        try:
+            os.makedirs(tempdir)
+        except OSError:
+            print 'Error creating tmp dir: %s' % tempdir
+            sys.exit(-1)
+
+    if devices == None or len(devices) <= 1:
+        # Run the groups one after another
+        devices = [ None ]
+
+    # Logs of each group: (log_dir, pid)
+    group_logs = [ None ] * len(groups)
+    stores     = []
+
+    if session_dir != None:
+        session = Session(tempdir, cmd, args, options)
+        session.open(resume)
+
+        group_logs = [ session.get(group) for group in groups ]
+        stores.append(session)
+
+        completed = len(groups) - group_logs.count(None)
+        if completed > 0:
+            print 'Resuming session %s: %d/%d groups already completed' % (session_dir, completed, len(groups))
+
+    if replay_cache:
+        results = ReplayCache(cmd, args, options, pinned = devices != [ None ])
+
+        cached = 0
+        for i, group in enumerate(groups):
+            if group_logs[i] == None:
+                group_logs[i] = results.get(group)
+                if group_logs[i] != None:
+                    cached += 1
+        stores.append(results)
+
+        if cached > 0:
+            print 'Reusing %d/%d groups from the replay cache' % (cached, len(groups))
+
+    def finished(replay):
+        for store in stores:
+            store.add(replay)
+
+    missing = [ i for i, logs in enumerate(group_logs) if logs == None ]
+
+    try:
+        # Each group writes its logs into its own directory, so the logs of the groups of a resumed session are
+        # never mixed up, even if the PIDs of their replays are the same
+        replays = launch_groups_parallel(cmd, args, options, [ groups[i] for i in missing ], devices, progress,
+                                         csv = csv, out_dir = tempdir, indexes = missing, group_dirs = True,
+                                         tee = tee, timeout = timeout, cancelled = cancelled, finished = finished)
+
+        # The logs of failed replays are never merged. The session only records the successful groups, so resuming
+        # it replays just the failed ones
+        failed = [ replay for replay in replays if replay.returncode != 0 ]
+        if len(failed) > 0:
+            raise ReplayFailed(failed)
+    except ReplayError:
+        if session_dir == None:
+            # Remove temporary output directory
+            shutil.rmtree(tempdir)
+        raise
+
+    for i, replay in zip(missing, replays):
+        group_logs[i] = (replay.log_dir, replay.pid)
+
+    try:
+        alignments = write_output(options, groups, metrics, group_logs, **kwargs)
+    finally:
+        if session_dir == None:
+            # Remove temporary output directory
+            shutil.rmtree(tempdir)
+
+    return alignments
+
+
+# Merges the logs of the replays of each group (a (log_dir, pid) pair per group), computes the metrics and writes
+# the output files of each GPU. Returns the alignment of the rows of the logs of each GPU
+def write_output(options, groups, metrics, group_logs, **kwargs):
     aggregate_mode = _get_elem(lambda opt: opt.name == 'countermodeaggregate',
                                options) != None
 
@@ -163,82 +809,158 @@ def launch_groups(cmd, args, options, groups, metrics, progress = None, **kwargs
     counter_names = [ counter.name for group in groups
                                    for counter in group ]
 
+    # Counters written to the output (by default, all the collected ones)
+    enabled_counters = kwargs.get('enabled_counters', None)
+    if enabled_counters == None:
+        enabled_counter_names = counter_names
+    else:
+        enabled_counter_names = [ counter.name for counter in enabled_counters ]
 
-    enabled_counter_names = [ counter.name for group in groups
-                                           for counter in group
-                                           if counter.active ]
-
-    csv              = kwargs.get('csv', True)
     out_file_pattern = kwargs.get('out_pattern', 'cuda_profile_%d.log')
+    stream           = kwargs.get('stream', False)
+    output_format    = kwargs.get('format', OUTPUT_FORMATS.CSV)
 
-    pid = os.getpid()
+    # Write a per-method summary of each GPU
+    write_summary = kwargs.get('summary', False)
 
-    # Create temporary output directory
-    tempdir = tempfile.gettempdir() + ('/cuda-profiler-tools.%d' % pid)
+    # Width (in ns) of the buckets of the utilization timeline of each GPU (None to not write it)
+    timeline_width = kwargs.get('timeline', None)
 
-    if not os.path.isdir(tempdir):
-        try:
-            os.mkdir(tempdir)
-        except OSError:
-            print 'Error creating tmp dir: %s' % tempdir
-            sys.exit(-1)
+    # Rows processed and written
+    row_filter = RowFilter(kwargs.get('kernel', None), kwargs.get('every', 1), kwargs.get('max_rows', None))
 
-    group_pids = []
+    # Directory where the merged counter values are archived (None to not archive them), and metrics that can be
+    # recomputed from the archive (by default, any metric that only needs the collected counters)
+    archive_dir     = kwargs.get('archive', None)
+    archive_metrics = kwargs.get('archive_metrics', None)
+    if archive_dir != None and archive_metrics == None:
+        archive_metrics = cuda.get_catalog().get_computable_metrics(counters.values())
 
-    for group in groups:
-        # Report progress
-        if progress != None:
-            progress.next()
+    if archive_dir != None and not os.path.isdir(archive_dir):
+        try:
+            os.makedirs(archive_dir)
+        except OSError:
+            raise ReplayError('Error creating archive dir: %s' % archive_dir)
 
-        group_pid = launch_group(cmd, args, options, group, csv = csv, out_dir = tempdir)
-        group_pids.append(group_pid)
+    log_dir, log_pid = group_logs[0]
+    gpus = len(glob.glob(log_dir + '/cuda_profile_%d_*.log' % log_pid))
 
-    gpus = len(glob.glob(tempdir + '/cuda_profile_%d_*.log' % group_pids[0]))
+    # Alignment of the rows of the logs of each GPU
+    alignments = []
 
     for gpu in range(gpus):
         files = []
-        for group_pid in group_pids:
-            files.append(tempdir + '/cuda_profile_%d_%d.log' % (group_pid, gpu))
+        for log_dir, log_pid in group_logs:
+            files.append(log_dir + '/cuda_profile_%d_%d.log' % (log_pid, gpu))
+
+        out_file = out_file_pattern % gpu
+
+        f      = None
+        writer = None
+
+        if output_format in (OUTPUT_FORMATS.CSV, OUTPUT_FORMATS.BOTH):
+            f = open(out_file, 'w')
+
+        if output_format in (OUTPUT_FORMATS.BIN, OUTPUT_FORMATS.BOTH):
+            writer = columnar.ColumnarWriter(columnar.get_file_name(out_file))
+
+        archive_writer = None
+        if archive_dir != None:
+            archive_writer = columnar.ColumnarWriter(archive.get_table_file_name(archive_dir, gpu))
+
+        if stream:
+            all_counter_columns, converters, kinds, rows, alignment = _merge_fields_streaming(files, row_filter)
+
+            # Process the merged rows in fixed-size chunks
+            chunks = _get_chunks(all_counter_columns, converters, kinds, rows, STREAM_CHUNK_LINES)
+        else:
+            data, alignment = merge_files(files, row_filter)
+            all_counter_columns = data.columns
+
+            chunks = [ data ]
+
+        if not alignment.aligned:
+            print 'GPU %d: the replays did not execute the same kernels. %s' % (gpu, alignment)
+
+        if write_summary:
+            gpu_summary = summary.Summary([ column for column in all_counter_columns
+                                                   if column in enabled_counter_names ] +
+                                          [ metric.name for metric in metrics ],
+                                          [ column for column in all_counter_columns if column in counter_names ])
+
+        gpu_timeline = None
+        if timeline_width != None:
+            if timeline.Timeline.is_supported(all_counter_columns):
+                gpu_timeline = timeline.Timeline(timeline_width)
+            else:
+                print 'GPU %d: the timeline needs the gpustarttimestamp and gpuendtimestamp options' % gpu
+
+        alignments.append(alignment)
 
-        all_counter_columns, data, nlines = merge_files(files)
         option_columns = [column for column in all_counter_columns if column not in counter_names]
         counter_columns = [column for column in all_counter_columns if column in enabled_counter_names]
 
-        metric_values = {}
+        header = True
 
-        if len(metrics) > 0:
-            metric_values = cuda.compute_metrics(gpu,
-                                                 metrics,
-                                                 all_counter_columns,
-                                                 data,
-                                                 nlines,
-                                                 counters,
-                                                 aggregate_mode)
+        for data in chunks:
+            metric_values = {}
 
-        metric_columns = [ name for name, value in metric_values.items() ]
+            if len(metrics) > 0:
+                metric_values = cuda.compute_metrics(gpu,
+                                                     metrics,
+                                                     all_counter_columns,
+                                                     data,
+                                                     data.nlines,
+                                                     counters,
+                                                     aggregate_mode)
 
-        f = open(out_file_pattern % gpu, 'w')
-        f.write(','.join(option_columns + counter_columns + metric_columns) + '\n')
+                if not alignment.aligned:
+                    _mask_missing_metrics(data, metrics, metric_values)
 
-        for line in range(nlines):
-            row = []
+            metric_columns = [ name for name, value in metric_values.items() ]
 
-            for k in option_columns:
-                row.append(data[k][line])
+            if f != None:
+                if header:
+                    f.write(','.join(option_columns + counter_columns + metric_columns) + '\n')
+                    header = False
 
-            for k in counter_columns:
-                row.append(data[k][line])
+                _write_lines(f, option_columns + counter_columns + metric_columns, data, metric_values)
 
-            for k in metric_columns:
-                row.append(metric_values[k][line])
+            if writer != None:
+                writer.write(option_columns + counter_columns + metric_columns, data, metric_values)
 
-            records = [ str(record) for record in row ]
+            if archive_writer != None:
+                # All the counters, so any metric that depends on them can be recomputed
+                archive_writer.write(all_counter_columns, data, {})
 
-            f.write(','.join(records) + '\n')
+            if write_summary:
+                gpu_summary.add(data, metric_values)
 
-        f.close()
+            if gpu_timeline != None:
+                gpu_timeline.add(data)
+
+        if f != None:
+            f.close()
+
+        if writer != None:
+            writer.close()
+
+        if archive_writer != None:
+            archive_writer.close()
+
+        if write_summary:
+            f = open(summary.get_file_name(out_file), 'w')
+            gpu_summary.write(f)
+            f.close()
+
+        if gpu_timeline != None:
+            f = open(timeline.get_file_name(out_file), 'w')
+            gpu_timeline.write(f)
+            f.close()
+
+    if archive_dir != None:
+        archive.write_catalog(archive_dir, options, counters.values(), archive_metrics, gpus)
 
-    # Remove temporary output directory
-    shutil.rmtree(tempdir)
+    return alignments
 
 # vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
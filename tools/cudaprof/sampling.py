@@ -0,0 +1,71 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+import numpy
+
+
+class RowFilter(object):
+    # Selects the rows of the merged logs that are processed and written: those whose method name matches the
+    # kernel regular expression, keeping one out of every "every" invocations of each method (starting with the
+    # first one), and up to max_rows rows in total
+    def __init__(self, kernel = None, every = 1, max_rows = None):
+        assert every >= 1, 'Invalid sampling interval'
+
+        if kernel != None:
+            self.kernel = re.compile(kernel)
+        else:
+            self.kernel = None
+
+        self.every    = every
+        self.max_rows = max_rows
+
+    def is_enabled(self):
+        return self.kernel != None or self.every > 1 or self.max_rows != None
+
+    def select(self, methods):
+        # Returns the numbers of the rows kept, given an iterable with the method name of each row
+        kept = []
+
+        matches = {}
+        seqs    = {}
+
+        for row, method in enumerate(methods):
+            if self.max_rows != None and len(kept) >= self.max_rows:
+                break
+
+            if self.kernel != None:
+                match = matches.get(method)
+                if match == None:
+                    match = self.kernel.search(method) != None
+                    matches[method] = match
+
+                if not match:
+                    continue
+
+            seq = seqs.get(method, 0)
+            seqs[method] = seq + 1
+
+            if seq % self.every == 0:
+                kept.append(row)
+
+        return numpy.array(kept, dtype = numpy.int64)
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -0,0 +1,196 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Profiling sessions split into independent jobs, so the replays of the counter groups can run on different hosts.
+# The plan directory (which must be shared by all the hosts) contains the plan manifest and a self-contained job
+# spec per group. Each job writes its profiler logs into its own directory of the plan, followed by a completion
+# marker. Once all the jobs are done, the logs are gathered and processed as in a regular session.
+
+import collections
+import glob
+import json
+import os
+import socket
+import tempfile
+
+import cudaprof.runner as runner
+from cudaprof.common import Option
+
+PLAN_MANIFEST = 'plan.json'
+PLAN_VERSION  = 1
+
+# Written into the log directory of a job once its replay has finished
+DONE_MARKER = 'done.json'
+
+# Counters of a job spec. Replaying a group only needs the names of its counters
+SpecCounter = collections.namedtuple('SpecCounter', [ 'name' ])
+
+
+def get_spec_file_name(plan_dir, index):
+    return os.path.join(plan_dir, 'group.%d.json' % index)
+
+
+def _get_log_dir(plan_dir, index):
+    return os.path.join(plan_dir, 'group.%d' % index)
+
+
+def _store(f_name, obj):
+    # Write to a temporary file and rename it, so readers never see half-written files
+    _f, tmp_name = tempfile.mkstemp(dir = os.path.dirname(f_name))
+    f = os.fdopen(_f, 'w')
+    json.dump(obj, f, indent = 1)
+    f.close()
+
+    os.rename(tmp_name, f_name)
+
+
+def _load(f_name):
+    try:
+        f = open(f_name)
+        obj = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        raise runner.ReplayError('Error reading %s' % f_name)
+
+    if obj.get('version') != PLAN_VERSION:
+        raise runner.ReplayError('Unsupported plan version in %s' % f_name)
+
+    return obj
+
+
+# Writes the plan manifest and the job spec of each group into plan_dir. Returns the names of the spec files
+def write_plan(plan_dir, cmd, args, options, groups, metrics, enabled_counters):
+    plan_dir = os.path.abspath(plan_dir)
+
+    if os.path.isfile(os.path.join(plan_dir, PLAN_MANIFEST)):
+        raise runner.ReplayError('Plan %s already exists' % plan_dir)
+
+    if not os.path.isdir(plan_dir):
+        try:
+            os.makedirs(plan_dir)
+        except OSError:
+            raise runner.ReplayError('Error creating plan dir: %s' % plan_dir)
+
+    specs = []
+
+    for index, group in enumerate(groups):
+        spec = { 'version' : PLAN_VERSION,
+                 'index'   : index,
+                 'cmd'     : cmd,
+                 'args'    : args,
+                 'options' : [ '%s' % option for option in options ],
+                 'counters': [ counter.name for counter in group ] }
+
+        f_name = get_spec_file_name(plan_dir, index)
+        _store(f_name, spec)
+        specs.append(f_name)
+
+    manifest = { 'version'         : PLAN_VERSION,
+                 'cmd'             : cmd,
+                 'args'            : args,
+                 'options'         : [ [ option.name, option.value ] for option in options ],
+                 'groups'          : [ [ counter.name for counter in group ] for group in groups ],
+                 'metrics'         : [ metric.name for metric in metrics ],
+                 'enabled_counters': [ counter.name for counter in enabled_counters ] }
+
+    # The manifest goes last, so a plan is never used before all its specs are written
+    _store(os.path.join(plan_dir, PLAN_MANIFEST), manifest)
+
+    return specs
+
+
+# Runs the job described by the spec file spec_file, leaving its logs in the plan directory (the one that contains
+# the spec file). Any previous run of the same job is discarded. Returns the Replay of the job. The job is only
+# marked as done if the program exits successfully, so gather never merges the logs of a failed replay
+def replay_group(spec_file, progress = None, **kwargs):
+    spec_file = os.path.abspath(spec_file)
+    spec = _load(spec_file)
+
+    log_dir = _get_log_dir(os.path.dirname(spec_file), spec['index'])
+    marker  = os.path.join(log_dir, DONE_MARKER)
+
+    if not os.path.isdir(log_dir):
+        try:
+            os.makedirs(log_dir)
+        except OSError:
+            raise runner.ReplayError('Error creating log dir: %s' % log_dir)
+    else:
+        for f_name in glob.glob(os.path.join(log_dir, 'cuda_profile_*.log')) + [ marker ]:
+            if os.path.isfile(f_name):
+                os.remove(f_name)
+
+    group = [ SpecCounter(name) for name in spec['counters'] ]
+
+    replays = runner.launch_groups_parallel(spec['cmd'], spec['args'], spec['options'], [ group ], [ None ], progress,
+                                            csv = kwargs.get('csv', True), out_dir = log_dir,
+                                            tee = kwargs.get('tee', False), timeout = kwargs.get('timeout', None))
+    replay = replays[0]
+
+    if replay.returncode != 0:
+        raise runner.ReplayError('Replay of %s %s' % (spec_file, replay.get_error()))
+
+    _store(marker, { 'version'   : PLAN_VERSION,
+                     'pid'       : replay.pid,
+                     'returncode': replay.returncode,
+                     'elapsed'   : replay.elapsed,
+                     'host'      : socket.gethostname() })
+
+    return replay
+
+
+# Merges the logs of the jobs of the plan in plan_dir and writes the output files (see runner.write_output). All
+# the jobs must be done. Counters, metrics and options are looked up by name in the given catalog
+def gather(plan_dir, catalog, **kwargs):
+    plan_dir = os.path.abspath(plan_dir)
+    plan = _load(os.path.join(plan_dir, PLAN_MANIFEST))
+
+    group_logs = []
+    pending    = []
+
+    for index in range(len(plan['groups'])):
+        log_dir = _get_log_dir(plan_dir, index)
+        marker  = os.path.join(log_dir, DONE_MARKER)
+
+        if not os.path.isfile(marker):
+            pending.append(index)
+            continue
+
+        group_logs.append((log_dir, _load(marker)['pid']))
+
+    if len(pending) > 0:
+        raise runner.ReplayError('Groups not replayed yet: %s' % ', '.join([ '%d' % index for index in pending ]))
+
+    def lookup(get, name):
+        element = get(name)
+        if element == None:
+            raise runner.ReplayError('%s is not available in this device' % name)
+        return element
+
+    options = []
+    for name, value in plan['options']:
+        option = lookup(catalog.get_option, name)
+        options.append(Option(option.name, option.description, value))
+
+    groups           = [ [ lookup(catalog.get_counter, name) for name in group ] for group in plan['groups'] ]
+    metrics          = [ lookup(catalog.get_metric, name) for name in plan['metrics'] ]
+    enabled_counters = [ lookup(catalog.get_counter, name) for name in plan['enabled_counters'] ]
+
+    return runner.write_output(options, groups, metrics, group_logs, enabled_counters = enabled_counters, **kwargs)
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
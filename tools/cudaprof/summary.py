@@ -0,0 +1,281 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-method summary of the merged logs, computed chunk by chunk in the same pass that writes the output. Memory
+# only depends on the number of methods and columns, not on the number of rows.
+
+import math
+import os
+
+import numpy
+
+from cudaprof.table import Column
+
+# Columns with execution times, which get totals, extremes and quantiles
+TIME_COLUMNS = [ 'gputime', 'cputime' ]
+
+QUANTILES = [ 0.5, 0.95, 0.99 ]
+
+
+def get_file_name(out_file):
+    # Name of the summary file written next to the output file out_file
+    return os.path.splitext(out_file)[0] + '.summary.csv'
+
+
+class QuantileSketch(object):
+    # Relative-error quantile sketch (as DDSketch). Positive values are counted in buckets with logarithmically
+    # growing bounds, so the quantiles returned have a relative error of at most alpha. Sketches can be merged, and
+    # their size is bounded by max_buckets (the lowest buckets are collapsed if needed)
+    def __init__(self, alpha = 0.01, max_buckets = 2048):
+        self.alpha       = alpha
+        self.gamma       = (1 + alpha) / (1 - alpha)
+        self.log_gamma   = math.log(self.gamma)
+        self.max_buckets = max_buckets
+
+        self.buckets = {}
+        # Number of values that are zero (or negative)
+        self.zeros   = 0
+        self.count   = 0
+
+    def add(self, values):
+        values = values[~numpy.isnan(values)]
+
+        positive = values > 0
+        self.zeros += len(values) - int(positive.sum())
+        self.count += len(values)
+
+        keys = numpy.ceil(numpy.log(values[positive]) / self.log_gamma).astype(numpy.int64)
+        keys, counts = numpy.unique(keys, return_counts = True)
+
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+        self._collapse()
+
+    def merge(self, other):
+        assert self.alpha == other.alpha, 'Sketches with different accuracy'
+
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+        self.zeros += other.zeros
+        self.count += other.count
+
+        self._collapse()
+
+    def _collapse(self):
+        if len(self.buckets) <= self.max_buckets:
+            return
+
+        keys = sorted(self.buckets)
+        lowest = keys[:len(keys) - self.max_buckets + 1]
+
+        count = sum(self.buckets.pop(key) for key in lowest)
+        self.buckets[lowest[-1]] = count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return float('nan')
+
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+
+        seen = self.zeros
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                # Value in the middle of the bucket (in relative terms)
+                return 2 * self.gamma ** key / (self.gamma + 1)
+
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class _TimeStats(object):
+    def __init__(self):
+        self.total  = 0.0
+        self.min    = float('inf')
+        self.max    = float('-inf')
+        self.sketch = QuantileSketch()
+
+    def add(self, values):
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0:
+            return
+
+        self.total += values.sum()
+        self.min    = min(self.min, values.min())
+        self.max    = max(self.max, values.max())
+        self.sketch.add(values)
+
+    def merge(self, other):
+        self.total += other.total
+        self.min    = min(self.min, other.min)
+        self.max    = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+
+class MethodSummary(object):
+    # Statistics of the rows of one method
+    def __init__(self):
+        self.count = 0
+        self.times = dict((column, _TimeStats()) for column in TIME_COLUMNS)
+        # Sum and number of (non-missing) values of each column
+        self.sums  = {}
+
+    def add(self, nrows, values):
+        # Adds nrows rows, with the given values for each column
+        self.count += nrows
+
+        for column, column_values in values.items():
+            if column in self.times:
+                self.times[column].add(column_values)
+            else:
+                present = column_values[~numpy.isnan(column_values)]
+
+                total, n = self.sums.get(column, (0.0, 0))
+                self.sums[column] = (total + present.sum(), n + len(present))
+
+    def merge(self, other):
+        self.count += other.count
+
+        for column, stats in other.times.items():
+            self.times[column].merge(stats)
+
+        for column, (total, n) in other.sums.items():
+            _total, _n = self.sums.get(column, (0.0, 0))
+            self.sums[column] = (_total + total, _n + n)
+
+    def get_mean(self, column):
+        if column in self.times:
+            n = self.times[column].sketch.count
+            return float(self.times[column].total) / n if n > 0 else float('nan')
+
+        total, n = self.sums.get(column, (0.0, 0))
+        return float(total) / n if n > 0 else float('nan')
+
+
+def _get_array(column):
+    # Float values of a column (NaN for missing cells), or None if it is not numeric
+    if isinstance(column, Column):
+        if not column.is_numeric():
+            return None
+
+        missing = column.get_missing()
+
+        if len(missing) + len([ value for value in column.exceptions.values()
+                                      if isinstance(value, (int, long, float)) ]) != len(column.exceptions):
+            return None
+
+        values = column.toarray(numpy.float64)
+        values[missing] = numpy.nan
+
+        return values
+
+    return column.astype(numpy.float64)
+
+
+class Summary(object):
+    # Per-method summary of a profile: number of invocations, total/mean/min/max and approximate quantiles of the
+    # execution times, and the mean of the given counter and metric columns. The rows without counters (e.g. the
+    # memory transfers, whose counter columns are padded with -1) are missing from the counter and metric means
+    def __init__(self, columns, counter_columns = ()):
+        self.columns         = list(columns)
+        self.counter_columns = list(counter_columns)
+        self.methods         = {}
+
+    def add(self, data, metric_values):
+        if 'method' not in data or data.nlines == 0:
+            return
+
+        methods = numpy.array(data['method'].tolist(), dtype = object)
+        names, inverse = numpy.unique(methods, return_inverse = True)
+
+        # Sort the rows by method, so the rows of each method are contiguous
+        order = numpy.argsort(inverse, kind = 'mergesort')
+        bounds = numpy.concatenate(([ 0 ], numpy.cumsum(numpy.bincount(inverse, minlength = len(names)))))
+
+        # Counters are never negative: -1 is the padding of the rows without counters
+        padded = numpy.zeros(data.nlines, dtype = bool)
+        for column in self.counter_columns:
+            if column in data:
+                array = _get_array(data[column])
+                if array is not None:
+                    with numpy.errstate(invalid = 'ignore'):
+                        padded |= array < 0
+
+        values = {}
+
+        for column in TIME_COLUMNS + self.columns:
+            if column in data:
+                array = _get_array(data[column])
+            elif column in metric_values:
+                array = _get_array(metric_values[column])
+            else:
+                array = None
+
+            if array is not None:
+                if column in self.columns and padded.any():
+                    array = numpy.where(padded, numpy.nan, array)
+                values[column] = array[order]
+
+        for n, name in enumerate(names.tolist()):
+            method = self.methods.get(name)
+            if method == None:
+                method = MethodSummary()
+                self.methods[name] = method
+
+            start, stop = bounds[n], bounds[n + 1]
+            method.add(int(stop - start),
+                       dict((column, column_values[start:stop]) for column, column_values in values.items()))
+
+    def merge(self, other):
+        for name, method in other.methods.items():
+            if name not in self.methods:
+                self.methods[name] = MethodSummary()
+            self.methods[name].merge(method)
+
+    def write(self, f):
+        header = [ 'method', 'count' ]
+        for column in TIME_COLUMNS:
+            header += [ '%s_%s' % (column, stat) for stat in [ 'total', 'mean', 'min', 'max' ] ]
+            header += [ '%s_p%d' % (column, int(q * 100)) for q in QUANTILES ]
+        header += [ '%s_mean' % column for column in self.columns ]
+
+        f.write(','.join(header) + '\n')
+
+        # Methods with the highest total GPU time first
+        methods = sorted(self.methods.items(), key = lambda item: -item[1].times['gputime'].total)
+
+        for name, method in methods:
+            records = [ name, method.count ]
+
+            for column in TIME_COLUMNS:
+                stats = method.times[column]
+                if stats.sketch.count > 0:
+                    records += [ float(stats.total), method.get_mean(column), float(stats.min), float(stats.max) ]
+                    records += [ stats.sketch.quantile(q) for q in QUANTILES ]
+                else:
+                    records += [ '' ] * (4 + len(QUANTILES))
+
+            records += [ method.get_mean(column) for column in self.columns ]
+
+            f.write(','.join([ str(record) for record in records ]) + '\n')
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -0,0 +1,398 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import itertools
+
+import numpy
+
+from cudaprof.common import enum
+
+COLUMN_KINDS = enum(INT      = 'int',
+                    FLOAT    = 'float',
+                    CATEGORY = 'category')
+
+# Storage used while the column is being filled: (array.array type, numpy dtype, fill value for exceptions)
+_STORAGE = {
+    COLUMN_KINDS.INT     : ('l', numpy.int64,   0),
+    COLUMN_KINDS.FLOAT   : ('d', numpy.float64, float('nan')),
+    COLUMN_KINDS.CATEGORY: ('i', numpy.int32,   -1),
+}
+
+# Value of the cells without data (e.g. rows that are missing in the log of a replay)
+MISSING = ''
+
+# Number of rows whose fields are gathered at once when building a table from text fields
+FIELD_CHUNK_LINES = 16384
+
+_INT_MIN = -(1 << 63)
+_INT_MAX = (1 << 63) - 1
+
+
+def _get_kind(value):
+    if isinstance(value, (int, long)):
+        if _INT_MIN <= value <= _INT_MAX:
+            return COLUMN_KINDS.INT
+        return None
+    elif isinstance(value, float):
+        return COLUMN_KINDS.FLOAT
+    elif isinstance(value, str) and value != MISSING:
+        return COLUMN_KINDS.CATEGORY
+
+    return None
+
+
+class Column(object):
+    # Typed column of a ProfileTable. Values are stored in a NumPy array whose type is given by the first value
+    # in the column. Strings are interned into a list of categories and the array stores their codes. Cells whose
+    # type does not match the one of the column (e.g. the -1 padding of memory transfers in a float column) are
+    # kept apart as exceptions, so the original values are always returned.
+    def __init__(self, kind, values, categories = None, exceptions = None):
+        self.kind       = kind
+        self.values     = values
+        self.categories = categories
+        self.exceptions = exceptions if exceptions != None else {}
+
+    @classmethod
+    def from_array(cls, values, exceptions = None):
+        return cls(COLUMN_KINDS.FLOAT if values.dtype.kind == 'f' else COLUMN_KINDS.INT, values,
+                   exceptions = exceptions)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, line):
+        if line in self.exceptions:
+            return self.exceptions[line]
+
+        if self.kind == COLUMN_KINDS.CATEGORY:
+            return self.categories[self.values[line]]
+
+        return self.values[line].item()
+
+    def tolist(self, start = 0, stop = None):
+        if stop == None:
+            stop = len(self.values)
+
+        values = self.values[start:stop].tolist()
+
+        if self.kind == COLUMN_KINDS.CATEGORY:
+            categories = self.categories
+            values = [ categories[code] for code in values ]
+
+        for line, value in self.exceptions.items():
+            if start <= line < stop:
+                values[line - start] = value
+
+        return values
+
+    def toarray(self, dtype):
+        # Numeric array with the values of the column (including the exceptions)
+        assert self.is_numeric(), 'Column is not numeric'
+
+        values = self.values.astype(dtype)
+
+        for line, value in self.exceptions.items():
+            # Missing cells keep the fill value of the column
+            if value != MISSING:
+                values[line] = value
+
+        return values
+
+    def is_numeric(self):
+        return self.kind != COLUMN_KINDS.CATEGORY
+
+    def get_missing(self):
+        # Lines without data
+        return [ line for line, value in self.exceptions.items() if value == MISSING ]
+
+    def update(self, lines, values):
+        # Sets the cells in the given lines to the given values
+        codes = None
+
+        if self.kind == COLUMN_KINDS.CATEGORY:
+            # The list of categories may be shared with other columns (see take)
+            self.categories = list(self.categories)
+            codes = dict((category, code) for code, category in enumerate(self.categories))
+
+        for line, value in zip(lines, values):
+            self.exceptions.pop(line, None)
+
+            if _get_kind(value) != self.kind:
+                self.values[line] = _STORAGE[self.kind][2]
+                self.exceptions[line] = value
+            elif codes != None:
+                code = codes.get(value)
+                if code == None:
+                    code = len(self.categories)
+                    codes[value] = code
+                    self.categories.append(intern(value))
+                self.values[line] = code
+            else:
+                self.values[line] = value
+
+    def take(self, lines):
+        # New column with the given lines of this one (an array of line numbers, where -1 means a missing cell)
+        missing = lines < 0
+        fill = _STORAGE[self.kind][2]
+
+        if len(self.values) > 0:
+            values = self.values[numpy.where(missing, 0, lines)]
+            values[missing] = fill
+        else:
+            values = numpy.empty(len(lines), dtype = self.values.dtype)
+            values.fill(fill)
+
+        exceptions = {}
+
+        if len(self.exceptions) > 0:
+            for line in numpy.flatnonzero(numpy.in1d(lines, self.exceptions.keys())).tolist():
+                exceptions[line] = self.exceptions[lines[line]]
+
+        for line in numpy.flatnonzero(missing).tolist():
+            exceptions[line] = MISSING
+
+        return Column(self.kind, values, self.categories, exceptions)
+
+
+class _ColumnBuilder(object):
+    def __init__(self, kind = None):
+        self.kind       = None
+        self.values     = None
+        self.categories = None
+        self.codes      = None
+        self.exceptions = {}
+        self.nlines     = 0
+
+        if kind != None:
+            self._set_kind(kind)
+
+    def _set_kind(self, kind):
+        self.kind   = kind
+        self.values = array.array(_STORAGE[kind][0], [ _STORAGE[kind][2] ] * self.nlines)
+
+        if kind == COLUMN_KINDS.CATEGORY:
+            self.categories = []
+            self.codes      = {}
+
+    def append(self, value):
+        kind = _get_kind(value)
+
+        if self.kind == None and kind != None:
+            self._set_kind(kind)
+
+        if self.kind == None or kind != self.kind:
+            self.exceptions[self.nlines] = value
+            if self.kind != None:
+                self.values.append(_STORAGE[self.kind][2])
+        elif kind == COLUMN_KINDS.CATEGORY:
+            code = self.codes.get(value)
+            if code == None:
+                code = len(self.categories)
+                self.codes[value] = code
+                self.categories.append(intern(value))
+            self.values.append(code)
+        else:
+            self.values.append(value)
+
+        self.nlines += 1
+
+    def get_column(self):
+        if self.kind == None:
+            # No typed values in the column
+            kind = COLUMN_KINDS.INT
+            values = numpy.zeros(self.nlines, dtype = numpy.int64)
+        else:
+            kind = self.kind
+            dtype = _STORAGE[kind][1]
+            if self.nlines > 0:
+                values = numpy.frombuffer(self.values, dtype = dtype)
+            else:
+                values = numpy.zeros(0, dtype = dtype)
+
+        return Column(kind, values, self.categories, self.exceptions)
+
+
+def _get_field_kind(fields, converter):
+    # Kind of the first value of the column that has one (None if there is none)
+    for field in fields:
+        kind = _get_kind(converter(field))
+        if kind != None:
+            return kind
+
+    return None
+
+
+def _convert_fields(fields, kind, converter):
+    # Column with the values of the fields converted one by one
+    builder = _ColumnBuilder(kind)
+
+    for field in fields.tolist():
+        builder.append(converter(field))
+
+    return builder.get_column()
+
+
+def _convert_column(fields, converter, kind = None):
+    # Column with the values of fields (a NumPy array of strings) as returned by converter. The fields are converted
+    # in bulk according to the kind of the column (taken from its values if not given), and only the cells that do
+    # not have that kind are converted one by one (and kept as exceptions)
+    if kind == None:
+        kind = _get_field_kind(fields, converter)
+
+    if len(fields) == 0 or kind == None:
+        return _convert_fields(fields, kind, converter)
+
+    if kind == COLUMN_KINDS.INT:
+        missing = fields == MISSING
+
+        try:
+            values = numpy.where(missing, '0', fields).astype(numpy.int64)
+        except (ValueError, OverflowError):
+            return _convert_fields(fields, kind, converter)
+
+        return Column(kind, values, exceptions = dict.fromkeys(numpy.flatnonzero(missing).tolist(), MISSING))
+
+    elif kind == COLUMN_KINDS.FLOAT:
+        # Fields without a decimal point may not be floats (e.g. the -1 padding of memory transfers)
+        dotted = numpy.char.find(fields, '.') >= 0
+
+        values = numpy.empty(len(fields), dtype = numpy.float64)
+
+        try:
+            values[dotted] = fields[dotted].astype(numpy.float64)
+        except ValueError:
+            return _convert_fields(fields, kind, converter)
+
+        exceptions = {}
+
+        others = numpy.flatnonzero(~dotted)
+        for line, field in zip(others.tolist(), fields[others].tolist()):
+            value = converter(field)
+
+            if _get_kind(value) == kind:
+                values[line] = value
+            else:
+                values[line] = _STORAGE[kind][2]
+                exceptions[line] = value
+
+        return Column(kind, values, exceptions = exceptions)
+
+    # Only the distinct fields are converted
+    categories, codes = numpy.unique(fields, return_inverse = True)
+    categories = categories.tolist()
+
+    values = [ converter(category) for category in categories ]
+    valid  = numpy.array([ _get_kind(value) == kind for value in values ], dtype = bool)
+
+    exceptions = {}
+
+    if not valid.all():
+        for line in numpy.flatnonzero(~valid[codes]).tolist():
+            exceptions[line] = values[codes[line]]
+
+        # Codes of the valid categories
+        new_codes = numpy.cumsum(valid, dtype = numpy.int32) - 1
+        new_codes[~valid] = _STORAGE[kind][2]
+
+        codes      = new_codes[codes]
+        categories = [ category for category, is_valid in zip(categories, valid.tolist()) if is_valid ]
+
+    return Column(kind, codes.astype(numpy.int32), [ intern(category) for category in categories ], exceptions)
+
+
+class ProfileTable(object):
+    # Columnar, typed table with the contents of the profiler logs
+    def __init__(self, columns, data, nlines):
+        self.columns = list(columns)
+        self.data    = dict(zip(self.columns, data))
+        self.nlines  = nlines
+
+    @classmethod
+    def from_rows(cls, columns, rows):
+        builders = [ _ColumnBuilder() for column in columns ]
+        nlines = 0
+
+        for row in rows:
+            for builder, value in zip(builders, row):
+                builder.append(value)
+
+            nlines += 1
+
+        return cls(columns, [ builder.get_column() for builder in builders ], nlines)
+
+    @classmethod
+    def from_fields(cls, columns, rows, converters, kinds = None):
+        # Table with rows of text fields (one per column) converted with the converter of each column. The fields
+        # of each column are gathered into a NumPy array of strings, so the conversion is done in bulk. kinds are
+        # the kinds of the columns, if known (e.g. inferred by ProfileLog)
+        fields = [ [] for column in columns ]
+        nlines = 0
+
+        rows = iter(rows)
+
+        while True:
+            chunk = list(itertools.islice(rows, FIELD_CHUNK_LINES))
+            if len(chunk) == 0:
+                break
+
+            for column_fields, values in zip(fields, zip(*chunk)):
+                column_fields.append(numpy.array(values))
+
+            nlines += len(chunk)
+
+        if kinds == None:
+            kinds = [ None ] * len(columns)
+
+        data = []
+
+        for column_fields, converter, kind in zip(fields, converters, kinds):
+            if len(column_fields) > 0:
+                column_fields = numpy.concatenate(column_fields)
+            else:
+                column_fields = numpy.zeros(0, dtype = 'S1')
+
+            data.append(_convert_column(column_fields, converter, kind))
+
+        return cls(columns, data, nlines)
+
+    def __contains__(self, column):
+        return column in self.data
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def __len__(self):
+        return self.nlines
+
+    def take(self, lines):
+        # New table with the given lines of this one (see Column.take)
+        return ProfileTable(self.columns, [ self.data[column].take(lines) for column in self.columns ], len(lines))
+
+    def add_column(self, column, data):
+        if not isinstance(data, Column):
+            data = Column.from_array(data)
+
+        assert len(data) == self.nlines, 'Wrong number of lines in column %s' % column
+
+        if column not in self.data:
+            self.columns.append(column)
+        self.data[column] = data
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab:
@@ -0,0 +1,196 @@
+# Author: Javier Cabezas <javier.cabezas@bsc.es>
+#
+# Copyright (c) 2013 Barcelona Supercomputing Center
+#                    IMPACT Research Group
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Utilization of a GPU over time, computed chunk by chunk from the gpustarttimestamp/gpuendtimestamp columns of the
+# merged logs. Memory depends on the length of the run divided by the bucket width, not on the number of rows.
+
+import os
+
+import numpy
+
+from cudaprof.log import get_timestamp
+from cudaprof.table import COLUMN_KINDS
+
+# Prefix of the method names of memory transfers
+TRANSFER_PREFIX = 'memcpy'
+
+
+def get_file_name(out_file):
+    # Name of the timeline file written next to the output file out_file
+    return os.path.splitext(out_file)[0] + '.timeline.csv'
+
+
+def _get_timestamps(column):
+    if column.kind != COLUMN_KINDS.CATEGORY:
+        return numpy.array([ get_timestamp(value) for value in column.tolist() ], dtype = numpy.int64)
+
+    # Timestamps are kept as text (see log.py), so each distinct value is parsed once. The codes of the exceptions
+    # are -1, which picks the -1 appended to the parsed categories
+    values = numpy.array([ get_timestamp(category) for category in column.categories ] + [ -1 ], dtype = numpy.int64)
+
+    timestamps = values[column.values]
+
+    for line, value in column.exceptions.items():
+        timestamps[line] = get_timestamp(value)
+
+    return timestamps
+
+
+def _get_sizes(column, nlines):
+    if column == None:
+        return numpy.zeros(nlines, dtype = numpy.int64)
+
+    sizes = numpy.array([ value if isinstance(value, (int, long)) and value > 0 else 0
+                          for value in column.tolist() ], dtype = numpy.int64)
+
+    return sizes
+
+
+class Timeline(object):
+    # Kernels and memory transfers binned into fixed time buckets of width ns. For each bucket it keeps the time the
+    # GPU was busy, and the number of kernels, memory transfers and bytes transferred that started in the bucket.
+    # Intervals that span several buckets are split among them. Buckets are indexed by their absolute time, so rows
+    # can be added in any order
+    def __init__(self, width):
+        assert width > 0, 'Invalid bucket width'
+
+        self.width = width
+
+        # Absolute index of the first allocated bucket, and range of buckets used so far
+        self.base = None
+        self.lo   = None
+        self.hi   = None
+
+        self.busy      = None
+        self.kernels   = None
+        self.transfers = None
+        self.bytes     = None
+
+    @classmethod
+    def is_supported(cls, columns):
+        return 'gpustarttimestamp' in columns and ('gpuendtimestamp' in columns or 'gputime' in columns)
+
+    def _reserve(self, lo, hi):
+        # Make buckets lo to hi (absolute indexes, both included) available
+        if self.base == None:
+            self.base = lo
+            self.lo   = lo
+            self.hi   = hi
+
+            size = hi - lo + 1
+            self.busy      = numpy.zeros(size, dtype = numpy.int64)
+            self.kernels   = numpy.zeros(size, dtype = numpy.int64)
+            self.transfers = numpy.zeros(size, dtype = numpy.int64)
+            self.bytes     = numpy.zeros(size, dtype = numpy.int64)
+            return
+
+        before = max(self.base - lo, 0)
+        after  = max(hi - (self.base + len(self.busy) - 1), 0)
+
+        if before > 0 or after > 0:
+            # Grow geometrically, so appending buckets is amortized
+            if before > 0:
+                before = max(before, len(self.busy))
+            if after > 0:
+                after = max(after, len(self.busy))
+
+            for name in [ 'busy', 'kernels', 'transfers', 'bytes' ]:
+                values = getattr(self, name)
+                setattr(self, name, numpy.concatenate((numpy.zeros(before, dtype = values.dtype), values,
+                                                       numpy.zeros(after, dtype = values.dtype))))
+
+            self.base -= before
+
+        self.lo = min(self.lo, lo)
+        self.hi = max(self.hi, hi)
+
+    def add(self, data):
+        if data.nlines == 0:
+            return
+
+        starts = _get_timestamps(data['gpustarttimestamp'])
+
+        if 'gpuendtimestamp' in data:
+            ends = _get_timestamps(data['gpuendtimestamp'])
+        else:
+            # gputime is in us
+            ends = starts + (data['gputime'].toarray(numpy.float64) * 1e3).astype(numpy.int64)
+
+        if 'method' in data:
+            transfer = numpy.array([ isinstance(method, str) and method.startswith(TRANSFER_PREFIX)
+                                     for method in data['method'].tolist() ], dtype = bool)
+        else:
+            transfer = numpy.zeros(data.nlines, dtype = bool)
+
+        sizes = _get_sizes(data['memtransfersize'] if 'memtransfersize' in data else None, data.nlines)
+
+        valid = (starts >= 0) & (ends >= starts)
+        if not valid.any():
+            return
+
+        starts   = starts[valid]
+        ends     = ends[valid]
+        transfer = transfer[valid]
+        sizes    = sizes[valid]
+
+        first = starts // self.width
+        last  = numpy.maximum(ends - 1, starts) // self.width
+
+        self._reserve(int(first.min()), int(last.max()))
+
+        first -= self.base
+        last  -= self.base
+
+        # Intervals within a single bucket
+        single = first == last
+        numpy.add.at(self.busy, first[single], (ends - starts)[single])
+
+        # Intervals that span several buckets
+        for row in numpy.flatnonzero(~single).tolist():
+            start, end = int(starts[row]), int(ends[row])
+            i, j = int(first[row]), int(last[row])
+
+            self.busy[i]       += (self.base + i + 1) * self.width - start
+            self.busy[i + 1:j] += self.width
+            self.busy[j]       += end - (self.base + j) * self.width
+
+        numpy.add.at(self.kernels, first[~transfer], 1)
+        numpy.add.at(self.transfers, first[transfer], 1)
+        numpy.add.at(self.bytes, first[transfer], sizes[transfer])
+
+    def write(self, f):
+        f.write('start,busy,kernels,transfers,bytes\n')
+
+        if self.base == None:
+            return
+
+        lo = self.lo - self.base
+        hi = self.hi - self.base + 1
+
+        # Concurrent kernels may add up to more than the bucket width
+        busy = numpy.minimum(self.busy[lo:hi] / float(self.width), 1.0)
+
+        for i, (busy, kernels, transfers, size) in enumerate(zip(busy.tolist(),
+                                                                self.kernels[lo:hi].tolist(),
+                                                                self.transfers[lo:hi].tolist(),
+                                                                self.bytes[lo:hi].tolist())):
+            # Start of the bucket, in ns since the start of the first bucket
+            f.write('%d,%s,%d,%d,%d\n' % (i * self.width, busy, kernels, transfers, size))
+
+
+# vim:set backspace=2 tabstop=4 shiftwidth=4 textwidth=120 foldmethod=marker expandtab: